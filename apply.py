@@ -1,6 +1,16 @@
+import bisect
+from collections import defaultdict
+
 from common.api import ExtensionAPI
 from common.diff import get_matches
-from labml import monit
+from common.imports import lazy_import
+
+monit = lazy_import('labml.monit')
+
+# Python-list DP cells held at once by `apply_blocks` before it switches to linear memory
+APPLY_DP_CELLS = 1 << 20
+# Extra content lines around a block's anchors that `apply_blocks` aligns it against
+WINDOW_MARGIN = 20
 
 
 def clean_block(block):
@@ -41,18 +51,47 @@ def get_blocks(lines):
     return blocks
 
 
-def find_best_match(content, block):
-    best = (-1, 0)
+def index_lines(content):
+    """Stripped lines of `content`, and the positions of each non-blank stripped line."""
+    stripped = [line.strip() for line in content]
+    positions = defaultdict(list)
+    for i, line in enumerate(stripped):
+        if line:
+            positions[line].append(i)
 
-    for i in range(len(content)):
-        current = 0
-        for j, line in enumerate(block):
-            if i + j >= len(content):
-                break
-            if line.strip() == content[i + j].strip() and line.strip():
-                current += 1.
-            else:
+    return stripped, positions
+
+
+def find_best_match(content, block, index=None, lo=0, reverse=False):
+    """First position in `content[lo:]` where the longest run of leading `block` lines matches,
+    ignoring surrounding whitespace; -1 if even the first line does not match.
+
+    With `reverse` the run of trailing lines is matched backwards and the last such position is returned.
+    Candidates come from the `index_lines` index, so only positions of the first line are verified.
+    """
+    if index is None:
+        index = index_lines(content)
+    stripped, positions = index
+
+    block = [line.strip() for line in block]
+    if reverse:
+        block = block[::-1]
+    if not block or not block[0]:
+        return -1
+
+    candidates = positions.get(block[0], [])
+    candidates = candidates[bisect.bisect_left(candidates, lo):]
+    if reverse:
+        candidates = reversed(candidates)
+
+    best = (-1, 0)
+    for i in candidates:
+        current = 1
+        while current < len(block) and block[current]:
+            k = i - current if reverse else i + current
+            if k < lo or k >= len(stripped) or stripped[k] != block[current]:
                 break
+            current += 1
 
         if current > best[1]:
             best = (i, current)
@@ -60,54 +99,98 @@ def find_best_match(content, block):
     return best[0]
 
 
-def apply_block(content, block, offset):
+def apply_block(content, block, offset, index=None):
     # assert len(block) > 2, block
 
-    start = find_best_match(content[offset:], block) + offset
+    if index is None:
+        index = index_lines(content)
+
+    start = find_best_match(content, block, index, offset)
     assert start >= 0, (start, block)
-    end = find_best_match(list(reversed(content[start + 1:])), list(reversed(block)))
+    end = find_best_match(content, block, index, start + 1, reverse=True)
 
     assert end >= 0, (start, end, block)
 
-    end = len(content) - end - 1
-
     return content[:start] + block + content[end + 1:], end + 1
 
-def apply_blocks(content, blocks, api):
-    from common.diff import compress_line, compare_line
+def align_lines(s_lines, s_content, block_starts):
+    """Match compressed suggestion lines to compressed content lines.
 
-    s_content = [compress_line(line) for line in content]
-    diff = []
-    block_starts = set()
-    for block in blocks:
-        block_starts.add(len(diff))
-        s_block = [compress_line(line) for line in block]
-        diff += [[compare_line(l1, l2) for l2 in s_content] for l1 in monit.iterate(s_block)]
+    Skipping content inside a block costs `0.1` per line; skipping before a block start is free.
+    """
+    from common.diff import compare_line, trace
 
-    dp = [[0. for _ in range(len(content) + 1)] for _ in range(len(diff) + 1)]
+    def table(i0, i1, j, bottom):
+        diff = [[compare_line(l1, l2) for l2 in s_content[j:]] for l1 in s_lines[i0:i1]]
+        dp = [None] * (i1 - i0) + [bottom]
 
-    for i in range(len(diff) - 1, -1, -1):
-        for j in range(len(content) - 1, -1, -1):
-            skip_decay = 0.1 if i not in block_starts else 0.0
-            dp[i][j] = max(
-                dp[i + 1][j],
-                dp[i][j + 1] - skip_decay,
-                dp[i + 1][j + 1] + diff[i][j],
-            )
+        for i in range(i1 - i0 - 1, -1, -1):
+            skip_decay = 0.1 if i0 + i not in block_starts else 0.0
+            dp[i] = [0.] * len(bottom)
+            for c in range(len(bottom) - 2, -1, -1):
+                dp[i][c] = max(
+                    dp[i + 1][c],
+                    dp[i][c + 1] - skip_decay,
+                    dp[i + 1][c + 1] + diff[i][c],
+                )
 
-    matches = []
-    i, j = 0, 0
-    while i < len(diff) and j < len(content):
+        return dp, diff
+
+    def step(dp, diff, i, j):
         if dp[i][j] == dp[i + 1][j + 1] + diff[i][j]:
-            matches.append((i, j))
-            i += 1
-            j += 1
+            return 1, 1
         elif dp[i + 1][j] < dp[i][j + 1]:
-            j += 1
+            return 0, 1
         else:
-            i += 1
+            return 1, 0
+
+    return trace(len(s_lines), len(s_content), table, step, [0.] * (len(s_content) + 1), APPLY_DP_CELLS)
+
+
+def align_windows(s_lines, s_content, blocks, index):
+    """Align each block only inside a window of content around its anchors.
 
-    matches.append([len(diff), len(content)])
+    Anchors are block lines that occur exactly once in the content, after the previous block's match.
+    Returns `None` when a block has no anchors or its anchors are too scattered to trust,
+    so that the caller can fall back to a global alignment.
+    """
+    _, positions = index
+    matches = []
+    row, lo = 0, 0
+    for block in blocks:
+        anchors = [positions[line.strip()][0] for line in block if len(positions.get(line.strip(), [])) == 1]
+        anchors = [p for p in anchors if p >= lo]
+        if not anchors or max(anchors) - min(anchors) > 2 * len(block) + WINDOW_MARGIN:
+            return None
+
+        start = max(lo, min(anchors) - len(block) - WINDOW_MARGIN)
+        end = min(len(s_content), max(anchors) + len(block) + WINDOW_MARGIN)
+        window = align_lines(s_lines[row:row + len(block)], s_content[start:end], {0})
+        matches += [(row + i, start + j) for i, j in window]
+        if window:
+            lo = start + window[-1][1] + 1
+        row += len(block)
+
+    return matches
+
+
+def apply_blocks(content, blocks, api):
+    from common.diff import compress_line, vocabulary
+
+    with vocabulary():
+        s_content = [compress_line(line) for line in content]
+        s_lines = []
+        block_starts = set()
+        for block in blocks:
+            block_starts.add(len(s_lines))
+            s_lines += [compress_line(line) for line in block]
+
+        with monit.section('Align'):
+            matches = align_windows(s_lines, s_content, blocks, index_lines(content))
+            if matches is None:
+                api.log('Could not anchor all blocks, aligning against the whole file')
+                matches = align_lines(s_lines, s_content, block_starts)
+    matches.append([len(s_lines), len(content)])
 
     api.log(str(matches))
 
@@ -1,14 +1,29 @@
 import json
 import re
+import threading
 import time
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 
-from common.api import ExtensionAPI
-from common.llm import call_llm
-from common.utils import extract_code_block
+from common.api import ExtensionAPI, File
+from common.code_context import (complete_identifier, definitions, enclosing_scopes, excerpt, identifiers,
+                                 import_rows, window)
+from common.llm import call_fim, call_llm, has_provider
+from common.utils import JSONArrayStream, extract_code_block
 from common.file_type import get_file_type
+from common.tokens import estimate_tokens
 
 MAX_PREDICTIONS = 4
+# Identifier completions from the open files, shown before and after the model's
+LOCAL_PREDICTIONS = 4
+# Fill-in-the-middle model from `FIM_TEMPLATES`, such as 'qwen_fim', to use instead of asking the chat model
+# for JSON when an API key serves it. Off by default, since few providers serve a base model for FIM
+FIM_MODEL = None
+# Send the code around the cursor and the definitions it uses, instead of whole files
+WINDOWED_CONTEXT = True
+# Prompt tokens of code with `WINDOWED_CONTEXT`
+CONTEXT_TOKENS = 2_000
+# Most lines above and below the cursor with `WINDOWED_CONTEXT`
+WINDOW_LINES = 80
 
 SYSTEM_PROMPT = """
 You are an expert programmer assisting a colleague in adding code to an existing file.
@@ -36,6 +51,12 @@ Each suggestion should be a complete, valid line of code. No markdown, no backti
 """.strip()
 
 COUNTER = 0
+# Latest run in this process; a newer request supersedes it
+_LATEST: Optional[ExtensionAPI] = None
+# Guards `COUNTER` and `_LATEST`; the resident host runs requests in overlapping threads
+_LATEST_LOCK = threading.Lock()
+# Last suggestions for each file, with the `context_key` they were made for
+_TYPEAHEAD: Dict[str, Tuple[Tuple[str, int, int], List[str]]] = {}
 
 
 def _get_last_word(prefix: str):
@@ -58,6 +79,10 @@ class AutocompleteExtension:
         self.other_files = api.opened_files
         self.current_file = api.current_file
 
+        # identifier completions, and what was last sent to the editor
+        self.local: List[Dict[str, Any]] = []
+        self.applied: Optional[List[Dict[str, Any]]] = None
+
         if self.row < len(self.lines):
             self.line = self.lines[self.row]
             self.line_prefix = self.line[:self.column]
@@ -71,24 +96,73 @@ class AutocompleteExtension:
         #              f' last word: `{self.last_word}`'
         #              f' line {self.line}')
 
-    def build_prompt(self) -> List[Dict[str, str]]:
-        """Build the prompt for the language model based on code context."""
+    def full_context(self) -> Tuple[str, str, List[Tuple[File, str]]]:
+        """Code before and after the cursor line, and the other opened files, all in full."""
         prefix = '\n'.join(self.lines[:self.row])
         suffix = '\n'.join(self.lines[self.row + 1:])
+        relevant = [(f, f.get_content()) for f in self.other_files if f.path != self.current_file.path]
+
+        return prefix, suffix, relevant
+
+    def windowed_context(self) -> Tuple[str, str, List[Tuple[File, str]]]:
+        """`full_context` cut down to about `CONTEXT_TOKENS` tokens.
+
+        Keeps up to `WINDOW_LINES` lines on each side of the cursor, then the imports, the enclosing scopes and
+        the definitions of names used in the window, from the current file and then from the other opened files.
+        """
+        start, end = window(self.lines, self.row, CONTEXT_TOKENS * 3 // 4, WINDOW_LINES)
+        used = sum(estimate_tokens(line) + 1 for line in self.lines[start:end])
+        names = identifiers(self.lines[start:end])
+
+        def add(lines: List[str], rows: List[int], kept: set):
+            nonlocal used
+            for r in rows:
+                cost = estimate_tokens(lines[r]) + 1
+                if r not in kept and used + cost <= CONTEXT_TOKENS:
+                    kept.add(r)
+                    used += cost
+
+        defined = definitions(self.lines)
+        kept = set(range(start, end))
+        add(self.lines, import_rows(self.lines), kept)
+        add(self.lines, enclosing_scopes(self.lines, self.row), kept)
+        add(self.lines, [r for name in sorted(names) for r in defined.get(name, [])], kept)
+
+        prefix = excerpt(self.lines[:self.row], [r for r in kept if r < self.row])
+        suffix = excerpt(self.lines[self.row + 1:], [r - self.row - 1 for r in kept if r > self.row])
+
+        relevant = []
+        for f in self.other_files:
+            if f.path == self.current_file.path:
+                continue
+            lines = f.get_content().splitlines()
+            defined = definitions(lines)
+            rows = set()
+            add(lines, [r for name in sorted(names) for r in defined.get(name, [])], rows)
+            if rows:
+                relevant.append((f, excerpt(lines, sorted(rows))))
+
+        return prefix, suffix, relevant
+
+    def build_prompt(self) -> List[Dict[str, str]]:
+        """Build the prompt for the language model based on code context."""
+        if WINDOWED_CONTEXT:
+            prefix, suffix, relevant = self.windowed_context()
+        else:
+            prefix, suffix, relevant = self.full_context()
 
         user_content = ''
         file_type = get_file_type(self.current_file.path)
 
-        if self.other_files:
+        if relevant:
             user_content += "First, I'll provide context on the other files relevant to this task, "
             user_content += "followed by content of the file I'm currently editing. "
             user_content += "Then, I will show you the insertion point and give you the instruction.\n\n"
 
             user_content += "## Relevant Files\n\n"
-            for f in self.other_files:
-                assert f.path != self.current_file.path
+            for f, content in relevant:
                 user_content += f'### `{f.path}`\n\n'
-                user_content += f'```{file_type}\n{f.get_content()}\n```\n\n'
+                user_content += f'```{get_file_type(f.path)}\n{content}\n```\n\n'
 
             user_content += f"\n\n## Current File\n\n"
             user_content += f"### `{self.current_file.path}`\n\n```{file_type}\n"
@@ -117,18 +191,60 @@ class AutocompleteExtension:
             {"role": "user", "content": user_content}
         ]
 
-    def get_completions(self) -> List[Dict[str, Any]]:
-        """Get completions for the current cursor position."""
+    def context_key(self) -> Tuple[str, int, int]:
+        """Identifies the code around the cursor line, which stays the same while the user types on it."""
+        return self.current_file.path, self.row, hash((tuple(self.lines[:self.row]), tuple(self.lines[self.row + 1:])))
 
-        start_time = time.time()
+    def filter_suggestions(self, suggestions: List[str]) -> List[Dict[str, Any]]:
+        """Completions from suggested lines that continue `line_prefix`."""
+        completions = []
+        seen = set()
+
+        for s in suggestions:
+            if not s.lstrip().startswith(self.line_prefix.lstrip()):
+                continue
+
+            s = s.lstrip()[len(self.line_prefix.lstrip()):]
+
+            if not s.strip():
+                continue
+
+            if s.strip() in seen:
+                continue
+
+            seen.add(s.strip())
+
+            label = self.last_word + s
+
+            completions.append({'label': label, 'text': self.line_prefix + s})
+
+        return completions[:MAX_PREDICTIONS]
+
+    def chat_suggestions(self) -> List[str]:
+        """Next-line suggestions from the chat model, asked for as JSON."""
         messages = self.build_prompt()
+        parser = JSONArrayStream('suggestions')
+        streamed = []
+
+        def on_content(text: str):
+            # show each suggestion once its JSON string is complete
+            added = [str(s).strip() for s in parser.feed(text)]
+            if added and not self.api.cancelled:
+                streamed.extend(added)
+                completions = self.filter_suggestions(streamed)
+                if completions:
+                    self.apply(completions)
 
         response_text = call_llm(self.api, 'devstral', messages,
                                  push_to_chat=False,
                                  max_tokens=512,
                                  temperature=0.8,
                                  top_p=0.8,
+                                 hedge=True,
+                                 on_content=on_content,
                                  )
+        if self.api.cancelled:
+            return []
 
         try:
             # Clean up response - remove any markdown code blocks if present
@@ -139,40 +255,103 @@ class AutocompleteExtension:
             self.api.log(f"Raw response: {response_text}")
             suggestions = []
 
-        time_elapsed = int((time.time() - start_time) * 1000)
+        return suggestions
 
-        # self.api.log(f"suggestions: {suggestions}")
+    def fim_suggestions(self) -> List[str]:
+        """Next-line suggestions from `FIM_MODEL`, which fills in the rest of the cursor line.
+
+        There are fewer than `MAX_PREDICTIONS` when the provider returns fewer completions.
+        """
+        if WINDOWED_CONTEXT:
+            prefix, suffix, _ = self.windowed_context()
+        else:
+            prefix, suffix, _ = self.full_context()
+
+        texts = call_fim(self.api, FIM_MODEL,
+                         f'{prefix}\n{self.line_prefix}' if prefix else self.line_prefix,
+                         f'{self.line[self.column:]}\n{suffix}',
+                         stop=['\n'],
+                         n_outputs=MAX_PREDICTIONS,
+                         max_tokens=64,
+                         temperature=0.8,
+                         top_p=0.8,
+                         )
+
+        return [(self.line_prefix + t).strip() for t in texts]
+
+    def apply(self, completions: List[Dict[str, Any]]):
+        """Send `completions` followed by the `local` ones they do not repeat, unless that was the last thing sent."""
+        texts = {c['text'] for c in completions}
+        completions = completions + [c for c in self.local if c['text'] not in texts]
+        if completions != self.applied:
+            self.api.apply_autocomplete(completions)
+            self.applied = completions
+
+    def cached_completions(self) -> List[Dict[str, Any]]:
+        """Completions from the last suggestions for this line, if the code around it has not changed."""
+        cached = _TYPEAHEAD.get(self.current_file.path)
+        if cached is None or cached[0] != self.context_key():
+            return []
+
+        return self.filter_suggestions(cached[1])
+
+    def local_completions(self) -> List[Dict[str, Any]]:
+        """Identifiers from the current and opened files that complete the word at the cursor."""
+        word = re.search(r'[A-Za-z_][\w.]*$|$', self.line_prefix).group(0)
+        other_files = [f.get_content().splitlines() for f in self.other_files if f.path != self.current_file.path]
+        names = complete_identifier(word, self.lines, self.row, other_files, LOCAL_PREDICTIONS)
 
         completions = []
-        seen = set()
+        for name in names:
+            s = name[len(word.rpartition('.')[2]):]
+            completions.append({'label': self.last_word + s, 'text': self.line_prefix + s})
 
-        for s in suggestions:
-            if not s.lstrip().startswith(self.line_prefix.lstrip()):
-                continue
+        return completions
 
-            s = s.lstrip()[len(self.line_prefix.lstrip()):]
+    def get_completions(self) -> List[Dict[str, Any]]:
+        """Get completions for the current cursor position.
 
-            if not s.strip():
-                continue
+        Suggestions for the same line and surrounding code are reused while the typed prefix still matches some.
+        """
+        completions = self.cached_completions()
+        if completions:
+            return completions
 
-            if s.strip() in seen:
-                continue
+        start_time = time.time()
 
-            seen.add(s.strip())
+        suggestions = []
+        if FIM_MODEL is not None and has_provider(self.api, FIM_MODEL):
+            suggestions = self.fim_suggestions()
+        if not suggestions and not self.api.cancelled:
+            suggestions = self.chat_suggestions()
 
-            label = self.last_word + s
+        if self.api.cancelled:
+            return []
 
-            completions.append({'label': label, 'text': self.line_prefix + s})
+        time_elapsed = int((time.time() - start_time) * 1000)
+
+        # self.api.log(f"suggestions: {suggestions}")
+
+        if suggestions:
+            _TYPEAHEAD[self.current_file.path] = (self.context_key(), suggestions)
+
+        completions = self.filter_suggestions(suggestions)
 
         # self.api.log(f'{time_elapsed}: Found {completions}')
 
-        return completions[:MAX_PREDICTIONS]
+        return completions
 
 
 def extension(api: ExtensionAPI) -> None:
     """Main extension entry point."""
-    global COUNTER
-    COUNTER += 1
+    global COUNTER, _LATEST
+    with _LATEST_LOCK:
+        COUNTER += 1
+
+        # the user typed again, so a run still waiting for the LLM is no longer wanted
+        if _LATEST is not None:
+            _LATEST.cancel()
+        _LATEST = api
 
     # api.log(f'{COUNTER}: Autocomplete extension started')
 
@@ -180,6 +359,14 @@ def extension(api: ExtensionAPI) -> None:
     autocomplete_ext = AutocompleteExtension(api)
     # api.log(f'"{autocomplete_ext.line_prefix}"')
 
+    # show identifier completions right away, unless earlier suggestions can answer at once
+    autocomplete_ext.local = autocomplete_ext.local_completions()
+    if autocomplete_ext.local and not autocomplete_ext.cached_completions():
+        autocomplete_ext.apply([])
+
     suggestions = autocomplete_ext.get_completions()
 
-    api.apply_autocomplete(suggestions)
+    if api.cancelled:
+        return
+
+    autocomplete_ext.apply(suggestions)
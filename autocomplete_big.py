@@ -1,9 +1,13 @@
 from common.api import ExtensionAPI
-from common.llm import call_llm
+from common.llm import call_fim, call_llm, has_provider
 from common.utils import extract_code_block
 from common.file_type import get_file_type
 from common.formatting import markdown_section, markdown_code_block
 
+# Fill-in-the-middle model from `FIM_TEMPLATES`, such as 'qwen_fim', to use instead of the chat model
+# when an API key serves it; the block ends at the first blank line. Off by default
+FIM_MODEL = None
+
 SYSTEM_PROMPT = """
 You are an expert programmer assisting a colleague in adding code to an existing file.
 
@@ -61,16 +65,28 @@ def extension(api: ExtensionAPI):
     idx = api.cursor_row - 1
     current_line = lines[idx][:api.cursor_column - 1]
 
-    messages = make_prompt(api,
-                           '\n'.join(lines[:idx]),
-                           '\n'.join(lines[idx+1:]),
-                           current_line)
+    completions = []
+    if FIM_MODEL is not None and has_provider(api, FIM_MODEL):
+        prefix = '\n'.join(lines[:idx] + [current_line])
+        suffix = '\n'.join([lines[idx][api.cursor_column - 1:]] + lines[idx + 1:])
+        completions = call_fim(api, FIM_MODEL, prefix, suffix, stop=['\n\n'], max_tokens=256, temperature=0.2)
+
+    if api.cancelled:
+        return
+
+    if completions:
+        content = current_line + completions[0]
+    else:
+        messages = make_prompt(api,
+                               '\n'.join(lines[:idx]),
+                               '\n'.join(lines[idx+1:]),
+                               current_line)
 
-    model = 'qwen'
-    api.start_chat()
+        model = 'qwen'
+        api.start_chat()
 
-    content = call_llm(api, model, messages)
-    content = extract_code_block(content)
+        content = call_llm(api, model, messages)
+        content = extract_code_block(content)
 
     if content.startswith(current_line):
         content = content[len(current_line):]
@@ -1,3 +1,12 @@
+import asyncio
+import atexit
+import concurrent.futures
+import functools
+import queue
+import threading
+import time
+import weakref
+
 import requests
 from pathlib import Path
 from typing import Dict, List, Optional, Union, Any
@@ -7,6 +16,119 @@ TAGS = {
     'meta': 'metadata'
 }
 
+# Editor callbacks waiting to be sent; `put` blocks when full, which throttles the producer
+OUTBOX_SIZE = 256
+
+_outbox: 'queue.Queue' = queue.Queue(maxsize=OUTBOX_SIZE)
+_sender: Optional[threading.Thread] = None
+_sender_lock = threading.Lock()
+_apis: 'weakref.WeakSet' = weakref.WeakSet()
+# guards adding to `_apis` against the sender and the exit drain iterating it
+_apis_lock = threading.Lock()
+# keep-alive connection pools, one per editor port, shared by every run
+_sessions: Dict[int, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def _get_session(port: int) -> requests.Session:
+    with _sessions_lock:
+        if port not in _sessions:
+            _sessions[port] = requests.Session()
+        return _sessions[port]
+
+
+def _live_apis() -> List['ExtensionAPI']:
+    with _apis_lock:
+        return list(_apis)
+
+
+def _flush_stale() -> Optional[float]:
+    """Send chat buffers older than their `chat_flush_interval`; seconds until the next one is due, if any."""
+    now = time.time()
+    due = None
+    for api in _live_apis():
+        if not api._chat_buffer:
+            continue
+        left = api._chat_buffer_time + api.chat_flush_interval - now
+        if left <= 0:
+            api.flush(block=False)
+            # still buffered if the producer held the buffer or the outbox was full
+            left = api.chat_flush_interval if api._chat_buffer else None
+        if left is not None and (due is None or left < due):
+            due = left
+
+    return due
+
+
+def _send_loop():
+    """Deliver queued editor callbacks one at a time, in the order they were queued.
+
+    Between callbacks, chat content left buffered longer than `chat_flush_interval` is flushed,
+    so the last text before a pause in `push_to_chat` is not held back.
+    """
+    while True:
+        try:
+            timeout = _flush_stale()
+        except Exception:
+            # never lose the only sender; the buffers are checked again shortly
+            timeout = ExtensionAPI.chat_flush_interval
+        try:
+            api, payload = _outbox.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        if api is None:
+            _outbox.task_done()
+            continue
+        try:
+            api._post(payload)
+        except Exception as e:
+            if api._send_error is None:
+                api._send_error = e
+        finally:
+            with api._delivered:
+                api._pending -= 1
+                api._delivered.notify_all()
+            _outbox.task_done()
+
+
+def _start_sender():
+    global _sender
+
+    with _sender_lock:
+        if _sender is None:
+            _sender = threading.Thread(target=_send_loop, name='extension-api-sender', daemon=True)
+            _sender.start()
+
+
+def _enqueue(api: 'ExtensionAPI', payload: Dict[str, Any], block: bool = True):
+    _start_sender()
+    with api._delivered:
+        api._pending += 1
+    try:
+        _outbox.put((api, payload), block=block)
+    except queue.Full:
+        with api._delivered:
+            api._pending -= 1
+        raise
+
+
+def _wake():
+    """Have the sender recompute when the next chat buffer is due."""
+    _start_sender()
+    try:
+        _outbox.put_nowait((None, None))
+    except queue.Full:
+        # the sender is busy and checks the buffers after each callback
+        pass
+
+
+@atexit.register
+def _drain():
+    """Deliver everything still buffered or queued before the process exits."""
+    for api in _live_apis():
+        api.flush()
+    _outbox.join()
+
 
 class ToolState:
     """Represents the state of a UI component in a tool interface."""
@@ -121,6 +243,9 @@ class ExtensionAPI:
             audio_blob_path: Path to audio blob file for voice input
             tool_action: Current tool action being performed
             tool_state: Dictionary of tool component states
+            chat_flush_interval: Seconds chat content is buffered before it is sent
+            chat_flush_size: Number of buffered chat characters that triggers a send
+            cancelled: Whether the run was cancelled, see `cancel`
     """
     _meta_data: Any
     repo_files: List[File]
@@ -145,6 +270,17 @@ class ExtensionAPI:
     tool_state: Optional[Dict[str, ToolState]]
 
     _blocks: List[str]
+    _chat_buffer: List[str]
+    _chat_buffer_size: int
+    _chat_buffer_time: float
+    _chat_lock: threading.Lock
+    _pending: int
+    _delivered: threading.Condition
+    _send_error: Optional[Exception]
+    _cancelled: threading.Event
+
+    chat_flush_interval: float = 0.05
+    chat_flush_size: int = 4096
 
     def load(self, **kwargs):
         self._meta_data = kwargs['meta_data']
@@ -195,16 +331,60 @@ class ExtensionAPI:
         self.api_keys = APIKeys(api_keys=api_keys)
 
         self._blocks = []
+        self._chat_buffer = []
+        self._chat_buffer_size = 0
+        self._chat_buffer_time = 0.
+        self._chat_lock = threading.Lock()
+        self._send_error = None
+        self._cancelled = threading.Event()
+        self._pending = 0
+        self._delivered = threading.Condition()
+        with _apis_lock:
+            _apis.add(self)
 
         return self
 
     def _dump(self, method: str, **kwargs):
+        self.flush()
+
+        _enqueue(self, self._payload(method, **kwargs))
+
+    def _payload(self, method: str, **kwargs) -> Dict[str, Any]:
         assert 'method' not in kwargs
         kwargs['method'] = method
         kwargs['meta_data'] = self._meta_data
 
+        return kwargs
+
+    def _post(self, payload: Dict[str, Any]):
         port = self._meta_data['port']
-        requests.post(f'http://localhost:{port}/api/extension', json=kwargs)
+        _get_session(port).post(f'http://localhost:{port}/api/extension', json=payload)
+
+    def wait(self):
+        """Block until all buffered and queued callbacks have been delivered to the editor.
+
+        Callbacks are sent by a background thread, so a failure to deliver one is raised here.
+        Only this API's callbacks are waited for, not those of runs in other threads.
+        """
+        self.flush()
+        with self._delivered:
+            self._delivered.wait_for(lambda: self._pending == 0)
+
+        if self._send_error is not None:
+            e, self._send_error = self._send_error, None
+            raise e
+
+    def cancel(self):
+        """Cancel this run, for example when the editor no longer wants its result.
+
+        Long-running work such as `call_llm` checks `cancelled` and stops early;
+        callbacks already made are still delivered.
+        """
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
 
     def get_terminal_data(self, terminal_name: str) -> Dict[str, List[str]]:
         """Get terminal data (snapshot and lines before reset) for a specific terminal.
@@ -215,16 +395,58 @@ class ExtensionAPI:
         Returns:
             Dictionary with 'snapshot' and 'before_reset' keys containing lists of strings
         """
+        # earlier callbacks reach the editor first
+        self.wait()
+
         port = self._meta_data['port']
-        response = requests.get(f'http://localhost:{port}/api/terminal/{terminal_name}')
+        response = _get_session(port).get(f'http://localhost:{port}/api/terminal/{terminal_name}')
         response.raise_for_status()
 
         result = response.json()
         return result['data']
 
     def push_to_chat(self, content: str):
-        """Send content to be displayed in the chat UI."""
-        self._dump('push_chat', content=content)
+        """Send content to be displayed in the chat UI.
+
+        Content is buffered and sent once `chat_flush_interval` has passed or
+        `chat_flush_size` characters have accumulated, at block boundaries, and before any other callback.
+        """
+        with self._chat_lock:
+            started = not self._chat_buffer
+            if started:
+                self._chat_buffer_time = time.time()
+            self._chat_buffer.append(content)
+            self._chat_buffer_size += len(content)
+
+        if (self._chat_buffer_size >= self.chat_flush_size or
+                time.time() - self._chat_buffer_time >= self.chat_flush_interval):
+            self.flush()
+        elif started:
+            _wake()
+
+    def flush(self, block: bool = True):
+        """Send buffered chat content.
+
+        With `block=False` nothing is sent if another thread holds the buffer or the outbox is full.
+        """
+        if not self._chat_lock.acquire(blocking=block):
+            return
+        try:
+            if not self._chat_buffer:
+                return
+
+            payload = self._payload('push_chat', content=''.join(self._chat_buffer))
+            if block:
+                _enqueue(self, payload)
+            else:
+                try:
+                    _enqueue(self, payload, block=False)
+                except queue.Full:
+                    return
+            self._chat_buffer = []
+            self._chat_buffer_size = 0
+        finally:
+            self._chat_lock.release()
 
     def start_block(self, type_: str):
         """Start a block of type `type`. `type_` can be `meta` or `think`."""
@@ -233,6 +455,7 @@ class ExtensionAPI:
 
         self.push_to_chat(f"\n<{tag}>")
         self._blocks.append(tag)
+        self.flush()
 
     def end_block(self):
         """
@@ -243,6 +466,7 @@ class ExtensionAPI:
         tag = self._blocks.pop(-1)
 
         self.push_to_chat(f'</{tag}>\n')
+        self.flush()
 
     def push_block(self, type_: str, content: str):
         """
@@ -322,6 +546,7 @@ class ExtensionAPI:
     def terminate_chat(self):
         """Terminate the current chat message."""
         self._dump('terminate_chat')
+        self.wait()
 
     def start_chat(self):
         """Start chat message"""
@@ -371,3 +596,46 @@ class ExtensionAPI:
             serialized_rows.append(serialized_row)
 
         self._dump('send_tool_interface', tool_interface={'title': title, 'rows': serialized_rows})
+
+
+class AsyncExtensionAPI:
+    """Awaitable view of an `ExtensionAPI`, for extensions that overlap LLM calls, file reads and callbacks.
+
+    Editor state (`current_file`, `api_keys`, ...) is read from the wrapped API.
+    Callbacks run in order on a single worker thread, so a full outbox never blocks the event loop.
+    """
+
+    CALLBACKS = (
+        'get_terminal_data', 'push_to_chat', 'flush', 'wait', 'start_block', 'end_block', 'push_block',
+        'push_meta', 'apply_autocomplete', 'apply_diff', 'send_diagnostics', 'send_inspector_results',
+        'send_symbol_results', 'apply_inline_completion', 'terminate_chat', 'start_chat', 'log',
+        'update_progress', 'notify', 'send_audio_transcription', 'send_tool_interface',
+    )
+
+    def __init__(self, api: ExtensionAPI):
+        self.api = api
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def __getattr__(self, name: str):
+        value = getattr(self.api, name)
+        if name not in self.CALLBACKS:
+            return value
+
+        async def callback(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(value, *args, **kwargs))
+
+        return callback
+
+    async def read_file(self, file: File) -> str:
+        """Read a file's content without blocking the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(None, file.get_content)
+
+
+def run_async(api: ExtensionAPI, extension):
+    """Run `async def extension(api: AsyncExtensionAPI)` from a regular extension entry point."""
+    async_api = AsyncExtensionAPI(api)
+    try:
+        return asyncio.run(extension(async_api))
+    finally:
+        async_api._executor.shutdown()
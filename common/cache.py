@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from .settings import LLM_CACHE_PATH, LLM_CACHE_SIZE, LLM_CACHE_TTL
+
+
+def cache_key(**request) -> str:
+    """Content hash of an LLM request."""
+    data = json.dumps(request, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _path(key: str) -> Path:
+    return Path(LLM_CACHE_PATH) / f'{key}.json'
+
+
+def load(key: str) -> Optional[Dict[str, Any]]:
+    """Cached response for `key`, or `None` if there is none or it is older than `LLM_CACHE_TTL`."""
+    path = _path(key)
+    try:
+        with open(path, 'r') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if time.time() - entry['created'] > LLM_CACHE_TTL:
+        path.unlink(missing_ok=True)
+        return None
+
+    # modification time is the recency used for eviction
+    os.utime(path)
+
+    return entry
+
+
+def save(key: str, entry: Dict[str, Any]):
+    """Store a response, then evict least recently used entries beyond `LLM_CACHE_SIZE` bytes."""
+    path = _path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    entry = {'created': time.time(), **entry}
+    tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(entry, f)
+    os.replace(tmp, path)
+
+    _evict()
+
+
+def _evict():
+    files = []
+    for p in Path(LLM_CACHE_PATH).glob('*.json'):
+        try:
+            stat = p.stat()
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, p))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, p in sorted(files):
+        if total <= LLM_CACHE_SIZE:
+            break
+        p.unlink(missing_ok=True)
+        total -= size
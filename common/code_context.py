@@ -0,0 +1,112 @@
+import re
+from typing import Dict, List, Set, Tuple
+
+from .tokens import estimate_tokens, keep_lines
+
+_IMPORT = re.compile(r'^(import\s|from\s+\S+\s+import\s|#include\s|using\s|package\s|require\(|use\s)')
+_DEFINITION = re.compile(r'^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?'
+                         r'(?:def|class|function|func|fn|interface|type|struct|enum|trait|const|let|var)\s+'
+                         r'([A-Za-z_$][\w$]*)')
+_ASSIGNMENT = re.compile(r'^([A-Za-z_]\w*)\s*(?::[^=]*)?=(?!=)')
+_IDENTIFIER = re.compile(r'[A-Za-z_$][\w$]*')
+
+
+def _indent(line: str) -> int:
+    return len(line) - len(line.lstrip())
+
+
+def enclosing_scopes(lines: List[str], row: int) -> List[int]:
+    """Rows of the lines that open the blocks enclosing `row`, outermost first.
+
+    An opener is the nearest line above with less indentation than everything below it so far, which covers
+    both indentation and brace based languages. On a blank `row`, the line above opens a block if it ends in `:` or `{`.
+    """
+    scopes = []
+    indent = _indent(lines[row]) if row < len(lines) and lines[row].strip() else None
+    for i in range(min(row, len(lines)) - 1, -1, -1):
+        if not lines[i].strip():
+            continue
+        if indent is None:
+            indent = _indent(lines[i])
+            if lines[i].rstrip().endswith((':', '{')):
+                scopes.append(i)
+        elif _indent(lines[i]) < indent:
+            scopes.append(i)
+            indent = _indent(lines[i])
+        if indent == 0:
+            break
+
+    return scopes[::-1]
+
+
+def import_rows(lines: List[str]) -> List[int]:
+    """Rows of top-level import statements."""
+    return [i for i, line in enumerate(lines) if _IMPORT.match(line)]
+
+
+def definitions(lines: List[str]) -> Dict[str, List[int]]:
+    """Rows that define each name: functions, classes, types and top-level variables."""
+    defined = {}
+    for i, line in enumerate(lines):
+        match = _DEFINITION.match(line) or _ASSIGNMENT.match(line)
+        if match:
+            defined.setdefault(match.group(1), []).append(i)
+
+    return defined
+
+
+def identifiers(lines: List[str]) -> Set[str]:
+    return set(_IDENTIFIER.findall('\n'.join(lines)))
+
+
+def window(lines: List[str], row: int, budget: int, max_lines: int) -> Tuple[int, int]:
+    """Rows `[start, end)` around `row` that fit in `budget` tokens, at most `max_lines` on each side."""
+    lo, hi = max(0, row - max_lines), min(len(lines), row + max_lines + 1)
+    start, end = keep_lines([estimate_tokens(line) + 1 for line in lines[lo:hi]], budget, row - lo)
+
+    return lo + start, lo + end
+
+
+def excerpt(lines: List[str], rows: List[int]) -> str:
+    """`lines` at `rows`, with `...` in place of each run of left out lines."""
+    text = []
+    last = -1
+    for r in sorted(set(rows)):
+        if r > last + 1:
+            text.append('...')
+        text.append(lines[r])
+        last = r
+    if last < len(lines) - 1:
+        text.append('...')
+
+    return '\n'.join(text)
+
+
+def complete_identifier(word: str, lines: List[str], row: int, other_files: List[List[str]], limit: int) -> List[str]:
+    """Identifiers in the code that complete `word`, nearest to `row` first.
+
+    A dotted `word` such as `self.na` completes names that follow the same qualifier, `self.`.
+    Names from `other_files` rank after those from `lines`. The line at `row`, being typed, is skipped.
+    """
+    qualifier, _, prefix = word.rpartition('.')
+    if qualifier:
+        pattern = re.compile(rf'(?<![\w.$]){re.escape(qualifier)}\.([A-Za-z_$][\w$]*)')
+    elif prefix:
+        pattern = _IDENTIFIER
+    else:
+        return []
+
+    distance = {}
+
+    def add(names, d):
+        for name in names:
+            if name.startswith(prefix) and name != prefix and d < distance.get(name, d + 1):
+                distance[name] = d
+
+    for r, line in enumerate(lines):
+        if r != row:
+            add(pattern.findall(line), abs(r - row))
+    for other in other_files:
+        add(pattern.findall('\n'.join(other)), len(lines))
+
+    return sorted(distance, key=lambda name: (distance[name], name))[:limit]
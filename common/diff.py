@@ -1,12 +1,58 @@
+import bisect
+import functools
 import re
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
 from typing import Tuple, List
 
-from labml import monit
+from .imports import lazy_import
+
+np = lazy_import('numpy')
+monit = lazy_import('labml.monit')
+
+# Upper bound on the number of cells in one padded LCS batch
+LCS_BATCH_CELLS = 1 << 20
+# Alignments with more cells than this run in linear memory
+LINEAR_DP_CELLS = 1 << 22
+# Distinct lines kept tokenized by `compress_line`
+LINE_CACHE_SIZE = 1 << 16
+# Interned tokens kept before the vocabulary is reset by `trim_cache`
+TOKEN_VOCAB_SIZE = 1 << 20
+
+# Token vocabulary shared by all compressed lines: token -> id, and id -> token length
+_TOKENS = {}
+_LENGTHS = []
+# Held while interning, and for a whole alignment so the vocabulary is not reset under it
+_VOCAB_LOCK = threading.RLock()
+
+
+def _lcs(l1, l2) -> int:
+    """Token-length weighted LCS of two token id tuples, bit-parallel (Allison–Dix / Hyyrö).
+
+    Every token is expanded to one symbol per character, which turns the weighted LCS into a plain
+    LCS over the expanded sequences; `l1` is then a bit vector and each symbol of `l2` is one step.
+    """
+    masks = {}
+    bit = 1
+    for t in l1:
+        for k in range(_LENGTHS[t]):
+            masks[t, k] = masks.get((t, k), 0) | bit
+            bit <<= 1
+
+    full = bit - 1
+    v = full
+    for t in l2:
+        for k in range(_LENGTHS[t]):
+            u = v & masks.get((t, k), 0)
+            v = ((v + u) | (v - u)) & full
+
+    return bin(full ^ v).count('1')
 
 
 def compare_line(l1, l2):
-    l1, s1 = l1
-    l2, s2 = l2
+    l1, s1, n1 = l1
+    l2, s2, n2 = l2
 
     if len(l1) == 0 and len(l2) == 0:
         return 0.0
@@ -20,16 +66,7 @@ def compare_line(l1, l2):
         pass
         # return s
 
-    d = [[0 for _ in range(len(l2) + 1)] for _ in range(len(l1) + 1)]
-    for i in range(len(l1) - 1, -1, -1):
-        for j in range(len(l2) - 1, -1, -1):
-            d[i][j] = max(
-                d[i + 1][j],
-                d[i][j + 1],
-                d[i + 1][j + 1] + (len(l1[i]) if l1[i] == l2[j] else 0),
-            )
-
-    s = d[0][0] / max(len(''.join(l1)), len(''.join(l2)))
+    s = _lcs(l1, l2) / max(n1, n2)
     if s > 0.5:
         return s
     else:
@@ -41,43 +78,313 @@ def split_string(s):
     return re.findall(pattern, s)
 
 
+def _intern(token: str) -> int:
+    idx = _TOKENS.get(token)
+    if idx is None:
+        with _VOCAB_LOCK:
+            idx = _TOKENS.get(token)
+            if idx is None:
+                idx = _TOKENS[token] = len(_LENGTHS)
+                _LENGTHS.append(len(token))
+    return idx
+
+
+@functools.lru_cache(maxsize=LINE_CACHE_SIZE)
 def compress_line(line):
+    """Tokenize a line into `(token ids, set of token ids, total token length)`.
+
+    Results are cached by line text, so re-aligning the same file skips the regex.
+    """
     parts = split_string(line)
-    return parts, set(parts)
+    tokens = tuple(_intern(t) for t in parts)
+    return tokens, frozenset(tokens), sum(len(t) for t in parts)
 
 
-def get_matches(v1: str, v2: str) -> Tuple[List[List[int]], List[str]]:
-    v1, v2 = v1.splitlines(keepends=True), v2.splitlines(keepends=True)
+def trim_cache():
+    """Reset the token vocabulary once it outgrows `TOKEN_VOCAB_SIZE`.
 
-    sv1 = [compress_line(line) for line in v1]
-    sv2 = [compress_line(line) for line in v2]
+    Token ids are only comparable within one vocabulary,
+    so this must only be called before compressing the lines of a new alignment.
+    """
+    with _VOCAB_LOCK:
+        if len(_LENGTHS) > TOKEN_VOCAB_SIZE:
+            _TOKENS.clear()
+            _LENGTHS.clear()
+            compress_line.cache_clear()
 
-    diff = [[compare_line(l1, l2) for l2 in sv2] for l1 in monit.iterate(sv1)]
 
-    dp = [[0 for _ in range(len(v2) + 1)] for _ in range(len(v1) + 1)]
+@contextmanager
+def vocabulary():
+    """Hold the token vocabulary for one alignment, trimming it first.
 
-    for i in range(len(v1) - 1, -1, -1):
-        for j in range(len(v2) - 1, -1, -1):
-            dp[i][j] = max(
-                dp[i + 1][j],
-                dp[i][j + 1],
-                dp[i + 1][j + 1] + diff[i][j],
-            )
+    Lines must be compressed and aligned inside this block;
+    alignments in other threads wait, so none of them sees the vocabulary reset.
+    """
+    with _VOCAB_LOCK:
+        trim_cache()
+        yield
 
-    matches = []
-    i, j = 0, 0
-    while i < len(v1) and j < len(v2):
-        if dp[i][j] == dp[i + 1][j + 1] + diff[i][j]:
-            matches.append((i, j))
-            i += 1
-            j += 1
-        elif dp[i][j] == dp[i + 1][j]:
-            i += 1
-        elif dp[i][j] == dp[i][j + 1]:
-            j += 1
+
+def _batch_lcs(seqs, weights, pairs) -> 'np.ndarray':
+    """Token-length weighted LCS of many sequence pairs at once.
+
+    Pairs are padded to a common shape and the LCS table is swept one row at a time
+    for the whole batch; padding never matches and carries zero weight.
+    """
+    res = np.zeros(len(pairs), dtype=np.int64)
+    order = sorted(range(len(pairs)), key=lambda k: (len(seqs[pairs[k][0]]), len(seqs[pairs[k][1]])))
+
+    start = 0
+    while start < len(order):
+        n1 = len(seqs[pairs[order[start]][0]])
+        end = start
+        n2 = 0
+        while end < len(order):
+            a, b = pairs[order[end]]
+            l1, l2 = max(n1, len(seqs[a])), max(n2, len(seqs[b]))
+            if end > start and (end - start + 1) * l1 * l2 > LCS_BATCH_CELLS:
+                break
+            n1, n2 = l1, l2
+            end += 1
+
+        batch = order[start:end]
+        t1 = np.full((len(batch), n1), -1, dtype=np.int64)
+        w1 = np.zeros((len(batch), n1), dtype=np.int64)
+        t2 = np.full((len(batch), n2), -2, dtype=np.int64)
+        for r, k in enumerate(batch):
+            a, b = pairs[k]
+            t1[r, :len(seqs[a])] = seqs[a]
+            w1[r, :len(seqs[a])] = weights[a]
+            t2[r, :len(seqs[b])] = seqs[b]
+
+        d = np.zeros((len(batch), n2 + 1), dtype=np.int64)
+        for i in range(n1 - 1, -1, -1):
+            gain = (t1[:, i:i + 1] == t2) * w1[:, i:i + 1]
+            row = np.maximum(d[:, :-1], d[:, 1:] + gain)
+            d[:, :-1] = np.maximum.accumulate(row[:, ::-1], axis=1)[:, ::-1]
+
+        res[batch] = d[:, 0]
+        start = end
+
+    return res
+
+
+def similarity_matrix(sv1, sv2) -> 'np.ndarray':
+    """`compare_line` for every pair of compressed lines, computed in bulk.
+
+    The Jaccard prefilter is evaluated for all pairs
+    from an inverted index, and only the surviving pairs of distinct lines run the LCS.
+    The result is bit-for-bit equal to calling `compare_line` on each pair.
+    """
+    n, m = len(sv1), len(sv2)
+    seqs, weights, lines = [], [], {}
+
+    def intern(sv):
+        ids, sizes, lengths = [], [], []
+        for tokens, token_set, length in sv:
+            if tokens not in lines:
+                lines[tokens] = len(seqs)
+                seqs.append(tokens)
+                weights.append([_LENGTHS[t] for t in tokens])
+            ids.append(lines[tokens])
+            sizes.append(len(token_set))
+            lengths.append(length)
+        return np.array(ids, dtype=np.int64), np.array(sizes, dtype=np.int64), np.array(lengths, dtype=np.int64)
+
+    ids1, size1, len1 = intern(sv1)
+    ids2, size2, len2 = intern(sv2)
+
+    postings1, postings2 = defaultdict(list), defaultdict(list)
+    for postings, ids in ((postings1, ids1), (postings2, ids2)):
+        for i, k in enumerate(ids):
+            for t in set(seqs[k]):
+                postings[t].append(i)
+
+    common = np.zeros((n, m), dtype=np.int64)
+    for t, rows in postings1.items():
+        cols = postings2.get(t)
+        if cols:
+            common[np.ix_(rows, cols)] += 1
+
+    size = np.maximum.outer(size1, size2)
+    empty = size == 0
+    s = common / np.where(empty, 1, size)
+
+    diff = np.where(s < 0.2, -1., s - 1.)
+    diff[empty] = 0.0
+
+    todo = (s >= 0.5) & ~empty
+    same = todo & (ids1[:, None] == ids2[None, :])
+    diff[same] = 1.0
+    todo &= ~same
+
+    rows, cols = np.nonzero(todo)
+    if len(rows) > 0:
+        keys = ids1[rows] * len(seqs) + ids2[cols]
+        keys, inverse = np.unique(keys, return_inverse=True)
+        pairs = [(int(k // len(seqs)), int(k % len(seqs))) for k in keys]
+        lcs = _batch_lcs(seqs, weights, pairs)[inverse.reshape(-1)]
+        s = lcs / np.maximum(len1[rows], len2[cols])
+        diff[rows, cols] = np.where(s > 0.5, s, s - 1.)
+
+    return diff
+
+
+def _unique_anchors(k1, k2, i0, i1, j0, j1) -> List[Tuple[int, int]]:
+    """Patience anchors: non-blank lines that occur exactly once in both ranges,
+    reduced to the longest run that is increasing on both sides."""
+    count1, count2 = Counter(k1[i0:i1]), Counter(k2[j0:j1])
+    position = {k2[j]: j for j in range(j0, j1) if count2[k2[j]] == 1}
+    candidates = [(i, position[k1[i]]) for i in range(i0, i1)
+                  if count1[k1[i]] == 1 and k1[i] in position and k1[i].strip()]
+
+    tails, tail_idx, prev = [], [], []
+    for c, (_, j) in enumerate(candidates):
+        t = bisect.bisect_left(tails, j)
+        prev.append(tail_idx[t - 1] if t > 0 else -1)
+        if t == len(tails):
+            tails.append(j)
+            tail_idx.append(c)
         else:
-            raise RuntimeError()
+            tails[t] = j
+            tail_idx[t] = c
+
+    anchors = []
+    c = tail_idx[-1] if tail_idx else -1
+    while c >= 0:
+        anchors.append(candidates[c])
+        c = prev[c]
+
+    return anchors[::-1]
+
+
+def _anchor(k1, k2) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int, int, int]]]:
+    """Pin identical lines before the fuzzy alignment.
+
+    Common prefixes and suffixes are matched directly and unique lines are used as anchors,
+    recursing into the gaps between them. Returns the pinned matches and the
+    `(i0, i1, j0, j1)` gaps left for the DP.
+    """
+    matches, gaps = [], []
+    stack = [(0, len(k1), 0, len(k2))]
+    while stack:
+        i0, i1, j0, j1 = stack.pop()
+        while i0 < i1 and j0 < j1 and k1[i0] == k2[j0]:
+            matches.append((i0, j0))
+            i0 += 1
+            j0 += 1
+        while i0 < i1 and j0 < j1 and k1[i1 - 1] == k2[j1 - 1]:
+            i1 -= 1
+            j1 -= 1
+            matches.append((i1, j1))
+        if i0 == i1 or j0 == j1:
+            continue
+
+        anchors = _unique_anchors(k1, k2, i0, i1, j0, j1)
+        if not anchors:
+            gaps.append((i0, i1, j0, j1))
+            continue
+
+        matches += anchors
+        bounds = [(i0 - 1, j0 - 1)] + anchors + [(i1, j1)]
+        for (a, b), (c, d) in zip(bounds, bounds[1:]):
+            stack.append((a + 1, c, b + 1, d))
+
+    return matches, gaps
+
+
+def trace(n: int, m: int, table, step, bottom, cells: int) -> List[Tuple[int, int]]:
+    """Greedy backtrack of a suffix DP over an `n` x `m` grid from `(0, 0)`.
+
+    `table(i0, i1, j, bottom)` fills rows `i0..i1` for columns `j..m`, given the dp row `bottom` at `i1`,
+    and returns `(dp, diff)` with `dp[-1] == bottom`.
+    `step(dp, diff, i, j)` picks the move `(di, dj)` from a cell of that table.
+
+    Grids up to `cells` are filled at once. Larger ones are split Hirschberg-style:
+    the dp row at the middle is swept up from the bottom, the top half is traced to find where
+    the path crosses it, and the bottom half continues from there. Only a few rows are held
+    per recursion level, so memory is linear in `n + m` and the matches are the same.
+    """
+    matches = []
+
+    def solve(i0, i1, j, bottom):
+        if j >= m:
+            return None
+        width = m - j + 1
+        if (i1 - i0) * width <= cells or i1 - i0 == 1:
+            dp, diff = table(i0, i1, j, bottom)
+            i, c = 0, 0
+            while i < i1 - i0:
+                if j + c >= m:
+                    return None
+                di, dc = step(dp, diff, i, c)
+                if di and dc:
+                    matches.append((i0 + i, j + c))
+                i += di
+                c += dc
+            return j + c
+
+        mid = (i0 + i1) // 2
+        chunk = max(1, cells // width)
+        row = bottom
+        for k in range(i1, mid, -chunk):
+            row = table(max(mid, k - chunk), k, j, row)[0][0]
+
+        c = solve(i0, mid, j, row)
+        if c is None:
+            return None
+        return solve(mid, i1, c, bottom[c - j:])
+
+    solve(0, n, 0, bottom)
+
+    return matches
+
+
+def _step(dp, diff, i, j):
+    if dp[i][j] == dp[i + 1][j + 1] + diff[i][j]:
+        return 1, 1
+    elif dp[i][j] == dp[i + 1][j]:
+        return 1, 0
+    elif dp[i][j] == dp[i][j + 1]:
+        return 0, 1
+    else:
+        raise RuntimeError()
+
+
+def _align(sv1, sv2) -> List[Tuple[int, int]]:
+    """Fuzzy line alignment that maximizes the total `compare_line` score."""
+
+    def table(i0, i1, j, bottom):
+        diff = similarity_matrix(sv1[i0:i1], sv2[j:])
+
+        # dp[i][j] = max(dp[i + 1][j], dp[i][j + 1], dp[i + 1][j + 1] + diff[i][j]);
+        # all values are non-negative, so the dp[i][j + 1] term is a running max from the right
+        dp = np.zeros((i1 - i0 + 1, len(bottom)))
+        dp[-1] = bottom
+        for i in range(i1 - i0 - 1, -1, -1):
+            row = np.maximum(dp[i + 1, :-1], dp[i + 1, 1:] + diff[i])
+            dp[i, :-1] = np.maximum.accumulate(row[::-1])[::-1]
+
+        return dp, diff
+
+    return trace(len(sv1), len(sv2), table, _step, np.zeros(len(sv2) + 1), LINEAR_DP_CELLS)
+
+
+def get_matches(v1: str, v2: str, *, anchor: bool = True) -> Tuple[List[List[int]], List[str]]:
+    v1, v2 = v1.splitlines(keepends=True), v2.splitlines(keepends=True)
+
+    if anchor:
+        matches, gaps = _anchor([line.rstrip('\r\n') for line in v1], [line.rstrip('\r\n') for line in v2])
+    else:
+        matches, gaps = [], [(0, len(v1), 0, len(v2))]
+
+    with vocabulary():
+        sv1 = [compress_line(line) for line in v1]
+        sv2 = [compress_line(line) for line in v2]
+        for i0, i1, j0, j1 in monit.iterate('Align', gaps):
+            matches += [(i0 + i, j0 + j) for i, j in _align(sv1[i0:i1], sv2[j0:j1])]
 
+    matches.sort()
     matches.append([len(v1), len(v2)])
 
-    return matches, v2
\ No newline at end of file
+    return matches, v2
@@ -1,10 +1,12 @@
-from git import Repo
+from .imports import lazy_import
+
+git = lazy_import('git')
 
 
 class GitClient:
     def __init__(self, project_path: str):
         self.project_path = project_path
-        self.repo = Repo(project_path)
+        self.repo = git.Repo(project_path)
 
     def is_repository(self) -> bool:
         """Check if the current directory is a git repository."""
@@ -0,0 +1,166 @@
+"""
+Resident process that runs extensions without paying interpreter and import start-up on each call.
+
+Run it from the extensions directory:
+
+    python -m common.host --port 7521 --preload autocomplete default
+
+Each request is one line of JSON on a TCP connection to `localhost:{port}`:
+
+    {"extension": "autocomplete", "data": {...}}
+
+where `data` is what `ExtensionAPI.load` takes. The extension runs in its own thread, and once its
+callbacks are delivered the host answers with `{"ok": true}` or `{"ok": false, "error": "<traceback>"}`.
+A connection can carry any number of requests, one at a time.
+
+A request with an `"id"` can be cancelled from another connection with
+
+    {"cancel": "<id>"}
+
+which calls `ExtensionAPI.cancel` on the run and answers `{"ok": true}`, or `{"ok": false}` if it is not running. Extension modules are kept loaded and re-imported when
+their source file changes; changes to `common/` need a restart.
+"""
+
+import argparse
+import importlib.util
+import json
+import re
+import socketserver
+import sys
+import threading
+import traceback
+import typing
+from pathlib import Path
+from typing import Dict, Tuple
+
+if typing.TYPE_CHECKING:
+    from common.api import ExtensionAPI
+
+EXTENSIONS_PATH = Path(__file__).parent.parent
+
+# Extension module names, such as `autocomplete` or `apply.model`; no path separators
+_EXTENSION_NAME = re.compile(r'[A-Za-z_][\w.]*')
+
+# Imported once at start-up, shared by every invocation
+PRELOAD = [
+    'common.api',
+    'common.llm',
+    'common.diff',
+    'common.utils',
+    'common.formatting',
+    'common.terminal',
+    'common.file_type',
+]
+
+_modules: Dict[str, Tuple[object, float]] = {}
+_modules_lock = threading.Lock()
+
+# Runs that can be cancelled, by request id
+_running: Dict[str, 'ExtensionAPI'] = {}
+_running_lock = threading.Lock()
+
+
+def load_extension(name: str):
+    """Extension module `name`, imported again if its source changed since it was last loaded.
+
+    `name` comes from the socket, so only modules directly in `EXTENSIONS_PATH` are loaded.
+    """
+    if not _EXTENSION_NAME.fullmatch(name):
+        raise ValueError(f'Invalid extension name: {name!r}')
+    path = EXTENSIONS_PATH / f'{name}.py'
+    if path.resolve().parent != EXTENSIONS_PATH.resolve():
+        raise ValueError(f'Extension {name!r} is outside {EXTENSIONS_PATH}')
+    mtime = path.stat().st_mtime
+
+    with _modules_lock:
+        if name in _modules and _modules[name][1] == mtime:
+            return _modules[name][0]
+
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _modules[name] = (module, mtime)
+
+        return module
+
+
+def run_extension(name: str, data: dict, request_id: str = None):
+    from common.api import ExtensionAPI
+
+    module = load_extension(name)
+    api = ExtensionAPI().load(**data)
+    if request_id is not None:
+        with _running_lock:
+            _running[request_id] = api
+    try:
+        module.extension(api)
+    finally:
+        if request_id is not None:
+            with _running_lock:
+                _running.pop(request_id, None)
+        api.wait()
+
+
+def cancel_extension(request_id: str) -> bool:
+    """Cancel the run of request `request_id`; `False` if it is not running."""
+    with _running_lock:
+        api = _running.get(request_id)
+    if api is None:
+        return False
+
+    api.cancel()
+    return True
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if 'cancel' in request:
+                    response = {'ok': cancel_extension(request['cancel'])}
+                else:
+                    run_extension(request['extension'], request['data'], request.get('id'))
+                    response = {'ok': True}
+            except Exception:
+                response = {'ok': False, 'error': traceback.format_exc()}
+
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve extension invocations from a resident process')
+    parser.add_argument('--port', type=int, default=7521)
+    parser.add_argument('--preload', nargs='*', default=[], help='extension modules to import at start-up')
+    args = parser.parse_args()
+
+    # extensions import `common.*`, and some import siblings as `extensions.*`
+    sys.path[:0] = [str(EXTENSIONS_PATH), str(EXTENSIONS_PATH.parent)]
+
+    for name in PRELOAD:
+        importlib.import_module(name)
+    for name in args.preload:
+        load_extension(name)
+
+    # the modules above import their heavy dependencies lazily, so the first call would still pay for them
+    from common.imports import HEAVY_MODULES, LAZY_MODULES
+    for name in sorted(set(HEAVY_MODULES) | LAZY_MODULES):
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+    with Server(('localhost', args.port), Handler) as server:
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Lazy imports for heavy dependencies, and an import-time check for extension entry points.
+
+    python -m common.imports analyze autocomplete
+
+imports each extension in a fresh interpreter and reports its import time and the heavy
+modules it pulled in. It exits with status 1 if any extension is over its budget.
+"""
+
+import importlib
+import json
+import subprocess
+import sys
+import types
+from pathlib import Path
+
+EXTENSIONS_PATH = Path(__file__).parent.parent
+
+# Modules that extensions should only import when they use them
+HEAVY_MODULES = ['openai', 'black', 'git', 'labml', 'numpy']
+# Every module passed to `lazy_import`, for a resident process to import ahead of use
+LAZY_MODULES = set()
+
+# Seconds allowed to import an extension module in a fresh interpreter
+DEFAULT_BUDGET = 0.3
+IMPORT_BUDGETS = {
+    'analyze': 0.2,
+    'autocomplete': 0.2,
+    'autocomplete_big': 0.2,
+    'default': 0.2,
+}
+
+
+class _LazyModule(types.ModuleType):
+    """Stands in for a module until one of its attributes is used."""
+
+    def __getattr__(self, name):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, name)
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """Module `name`, imported on first attribute access instead of now."""
+    LAZY_MODULES.add(name)
+    if name in sys.modules:
+        return sys.modules[name]
+
+    return _LazyModule(name)
+
+
+_MEASURE = '''
+import importlib.util, json, sys, time
+sys.path[:0] = [{path!r}, {parent!r}]
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location({name!r}, {file!r})
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+elapsed = time.perf_counter() - start
+print(json.dumps({{'time': elapsed, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def measure_import(name: str) -> dict:
+    """Import extension `name` in a fresh interpreter.
+
+    Returns its import `time` and the `heavy` modules loaded, or the last line of the `error` if the import failed.
+    """
+    code = _MEASURE.format(path=str(EXTENSIONS_PATH), parent=str(EXTENSIONS_PATH.parent),
+                           name=name, file=str(EXTENSIONS_PATH / f'{name}.py'), heavy=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    if result.returncode != 0:
+        return {'error': result.stderr.strip().splitlines()[-1]}
+
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    names = sys.argv[1:] or sorted(IMPORT_BUDGETS.keys())
+    over = False
+    for name in names:
+        result = measure_import(name)
+        if 'error' in result:
+            over = True
+            print(f'{name:20} FAILED  {result["error"]}')
+            continue
+
+        budget = IMPORT_BUDGETS.get(name, DEFAULT_BUDGET)
+        status = 'ok' if result['time'] <= budget else 'OVER'
+        over = over or result['time'] > budget
+        print(f'{name:20} {result["time"] * 1000:7.1f}ms / {budget * 1000:.0f}ms {status:4}'
+              f'  heavy: {", ".join(result["heavy"]) or "-"}')
+
+    sys.exit(1 if over else 0)
+
+
+if __name__ == '__main__':
+    main()
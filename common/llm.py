@@ -1,102 +1,607 @@
+import asyncio
+import functools
+import importlib.util
+import json
+import queue
+import threading
 import time
 import typing
-from typing import Dict, List
+import weakref
+from types import SimpleNamespace
+from typing import Any, Dict, List, Tuple
 
-from openai import OpenAI
+from . import cache as llm_cache
+from .imports import lazy_import
+from .models import FIM_TEMPLATES, MODELS
+from .settings import HEDGE_DELAY, HTTP2, HTTP_POOL_LIMITS, LLM_PROVIDERS, PROMPT_CACHE_CONTROL
 
-from .models import MODELS
-from .settings import LLM_PROVIDERS
+httpx = lazy_import('httpx')
+openai = lazy_import('openai')
+
+# OpenAI clients by (provider, key); async clients per event loop, since their connections belong to it
+_clients: Dict[Tuple[str, str], Any] = {}
+_async_clients: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
 
 if typing.TYPE_CHECKING:
-    from .api import ExtensionAPI
+    from .api import APIKey, AsyncExtensionAPI, ExtensionAPI
+
+
+def _select_providers(api: 'ExtensionAPI', model_id: str) -> List[Tuple[Dict[str, str], 'APIKey', str]]:
+    """`(provider, api_key, model_name)` for each configured provider that serves `model_id`, default key first."""
+    model_info = MODELS[model_id]
+
+    if len(api.api_keys.keys) == 0:
+        raise ValueError('API key required. Configure at least one in Extensions → Management.')
+
+    keys = []
+    if api.api_keys.default.provider in model_info:
+        keys.append(api.api_keys.default)
+    for k in api.api_keys.keys:
+        if k.provider in model_info and all(k.provider != s.provider for s in keys):
+            keys.append(k)
+
+    if not keys:
+        raise ValueError(f"The API provider does not support {model_id} model")
+
+    selected = []
+    for api_key in keys:
+        provider = None
+        for p in LLM_PROVIDERS:
+            if p['name'] == api_key.provider:
+                provider = p
+                break
+        selected.append((provider, api_key, model_info[api_key.provider]))
+
+    return selected
+
+
+def _select_provider(api: 'ExtensionAPI', model_id: str) -> Tuple[Dict[str, str], 'APIKey', str]:
+    """Pick the API key, its provider and the provider's model name for `model_id`."""
+    return _select_providers(api, model_id)[0]
+
+
+def has_provider(api: 'ExtensionAPI', model_id: str) -> bool:
+    """Whether one of the configured API keys is for a provider that serves `model_id`."""
+    return any(k.provider in MODELS[model_id] for k in api.api_keys.keys)
+
+
+def _http_options() -> Dict[str, Any]:
+    return {
+        'http2': HTTP2 and importlib.util.find_spec('h2') is not None,
+        'limits': httpx.Limits(**HTTP_POOL_LIMITS),
+    }
+
+
+def get_client(provider: Dict[str, str], api_key: 'APIKey'):
+    """Process-wide OpenAI client for a provider and key, so that calls reuse open connections."""
+    key = (provider['name'], api_key.key)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = openai.OpenAI(api_key=api_key.key, base_url=provider['base_url'],
+                                          http_client=openai.DefaultHttpxClient(**_http_options()))
+
+        return _clients[key]
+
+
+def get_async_client(provider: Dict[str, str], api_key: 'APIKey'):
+    """`get_client` for `AsyncOpenAI`, shared within the running event loop."""
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    key = (provider['name'], api_key.key)
+    if key not in clients:
+        clients[key] = openai.AsyncOpenAI(api_key=api_key.key, base_url=provider['base_url'],
+                                          http_client=openai.DefaultAsyncHttpxClient(**_http_options()))
+
+    return clients[key]
+
+
+def _prepare_messages(messages: List[Dict[str, Any]], provider: Dict[str, str], model_name: str) -> List[Dict[str, Any]]:
+    """Messages as the provider takes them.
+
+    A message with `'cache': True` ends a prefix that should be cached. Most providers cache prefixes
+    on their own; for models listed in `PROMPT_CACHE_CONTROL` the marker becomes a `cache_control` breakpoint.
+    """
+    explicit = any(model_name.startswith(prefix) for prefix in PROMPT_CACHE_CONTROL.get(provider['name'], []))
+
+    prepared = []
+    for message in messages:
+        message = dict(message)
+        if message.pop('cache', False) and explicit:
+            message['content'] = [{'type': 'text', 'text': message['content'], 'cache_control': {'type': 'ephemeral'}}]
+        prepared.append(message)
+
+    return prepared
+
+
+def _meta_data(elapsed: float, usage, model_name: str, provider: Dict[str, str],
+               cached: bool = False, cancelled: bool = False) -> str:
+    meta_data = f'Time: {elapsed:.2f}s'
+    if cached:
+        meta_data += ' (cached)'
+    if cancelled:
+        meta_data += ' (cancelled)'
+    if usage is not None:
+        meta_data += f' Prompt tokens: {usage.prompt_tokens :,}'
+        cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None)
+        if cached_tokens:
+            meta_data += f' ({cached_tokens :,} cached)'
+        meta_data += f' Completion tokens {usage.completion_tokens :,}, Model: {model_name} @ {provider["name"]}'
+
+    return meta_data.strip()
+
+
+def _stream_deltas(stream):
+    """`(reasoning, content, usage)` of each streamed chunk."""
+    for chunk in stream:
+        delta = chunk.choices[0].delta if chunk.choices else None
+        yield getattr(delta, 'reasoning', None), getattr(delta, 'content', None), chunk.usage
+
+
+async def _astream_deltas(stream):
+    """`(reasoning, content, usage)` of each chunk of an async stream."""
+    async for chunk in stream:
+        delta = chunk.choices[0].delta if chunk.choices else None
+        yield getattr(delta, 'reasoning', None), getattr(delta, 'content', None), chunk.usage
+
+
+def _cached_deltas(entry: Dict[str, Any]):
+    """Replay a cached response as the deltas it was streamed with."""
+    for kind, text in entry['chunks']:
+        if kind == 'reasoning':
+            yield text, None, None
+        else:
+            yield None, text, None
+
+    if entry['usage'] is not None:
+        yield None, None, json.loads(json.dumps(entry['usage']), object_hook=lambda d: SimpleNamespace(**d))
+
+
+async def _acached_deltas(entry: Dict[str, Any]):
+    for delta in _cached_deltas(entry):
+        yield delta
+
+
+class _HedgedStream:
+    """Deltas from the first of several requests to stream a token.
+
+    `starts` open the requests' streams. The first is started right away, and each next one when no
+    token has arrived `delay` seconds after the previous start, or as soon as it fails. Once a request
+    streams reasoning or content it is the `winner`, and the others close on their next chunk.
+    """
+
+    def __init__(self, starts: List[typing.Callable[[], Any]], delay: float):
+        self.starts = starts
+        self.delay = delay
+        self.winner = None
+        self.closed = False
+        self._events = queue.Queue()
+
+    def close(self):
+        """Stop every request; each closes its stream on its next chunk."""
+        self.closed = True
+
+    def _run(self, i: int):
+        try:
+            stream = self.starts[i]()
+            # streams are not thread-safe, so a losing request closes its own as soon as it sees it lost
+            for delta in _stream_deltas(stream):
+                if self.closed or (self.winner is not None and self.winner != i):
+                    stream.close()
+                    return
+                self._events.put((i, delta))
+            self._events.put((i, None))
+        except Exception as e:
+            if self.winner is None or self.winner == i:
+                self._events.put((i, e))
+
+    def _start(self, i: int):
+        threading.Thread(target=self._run, args=(i,), daemon=True).start()
+
+    def __iter__(self):
+        self._start(0)
+        started, failed = 1, 0
+        while True:
+            waiting = self.winner is None and started < len(self.starts)
+            try:
+                i, event = self._events.get(timeout=self.delay if waiting else None)
+            except queue.Empty:
+                self._start(started)
+                started += 1
+                continue
+
+            if self.winner is not None and i != self.winner:
+                continue
+
+            if isinstance(event, Exception):
+                failed += 1
+                if self.winner is not None or failed == len(self.starts):
+                    raise event
+                if started < len(self.starts) and failed == started:
+                    self._start(started)
+                    started += 1
+                continue
+
+            if event is None:
+                if self.winner is None:
+                    self.winner = i
+                return
+
+            reasoning, content, usage = event
+            if self.winner is None:
+                if not (reasoning or content or usage is not None):
+                    continue
+                self.winner = i
+            yield event
+
+
+class ReasoningDelta(typing.NamedTuple):
+    text: str
+
+
+class ContentDelta(typing.NamedTuple):
+    text: str
+
+
+class Usage(typing.NamedTuple):
+    usage: Any
+
+
+class Finish(typing.NamedTuple):
+    """Last event of `stream_llm`: who answered, how long it took, and whether it was cached or cancelled."""
+    provider: Dict[str, str]
+    model_name: str
+    elapsed: float
+    cached: bool
+    cancelled: bool
+
+
+LLMEvent = typing.Union[ReasoningDelta, ContentDelta, Usage, Finish]
+
+
+class _Transcript:
+    """Turns streamed deltas into events, keeping the response for the cache."""
+
+    def __init__(self):
+        self.usage = None
+        # (kind, pieces) of consecutive reasoning or content
+        self.chunks = []
+
+    def events(self, reasoning: str, content: str, usage) -> List[LLMEvent]:
+        for kind, text in (('reasoning', reasoning), ('content', content)):
+            if text:
+                if self.chunks and self.chunks[-1][0] == kind:
+                    self.chunks[-1][1].append(text)
+                else:
+                    self.chunks.append((kind, [text]))
+
+        events = []
+        if reasoning:
+            events.append(ReasoningDelta(reasoning))
+        if content:
+            events.append(ContentDelta(content))
+        if usage is not None:
+            assert self.usage is None
+            self.usage = usage
+            events.append(Usage(usage))
+
+        return events
+
+    def content(self) -> str:
+        return ''.join(''.join(pieces) for kind, pieces in self.chunks if kind == 'content')
+
+    def cache_entry(self) -> Dict[str, Any]:
+        return {'chunks': [[kind, ''.join(pieces)] for kind, pieces in self.chunks],
+                'usage': self.usage.model_dump() if self.usage is not None else None}
+
+
+def _cache_lookup(cache: bool, messages: List[Dict[str, Any]], provider: Dict[str, str], model_name: str, **options):
+    """`(key, entry)` of the request in the response cache; both `None` without `cache`."""
+    if not cache:
+        return None, None
+
+    key = llm_cache.cache_key(model=model_name, provider=provider['name'],
+                              messages=_prepare_messages(messages, provider, model_name), **options)
+    return key, llm_cache.load(key)
+
+
+class _ChatOutput:
+    """What `call_llm` and `acall_llm` do with each event: the editor callbacks to make, and the content."""
+
+    def __init__(self, push_to_chat: bool):
+        self.push_to_chat = push_to_chat
+        self.thinking = False
+        self.usage = None
+        self.content = []
+
+    def callbacks(self, event: LLMEvent) -> List[Tuple[str, Dict[str, Any]]]:
+        """`(method, kwargs)` of the `ExtensionAPI` callbacks for `event`."""
+        calls = []
+        if isinstance(event, ReasoningDelta):
+            if self.push_to_chat:
+                if not self.thinking:
+                    calls.append(('start_block', {'type_': 'think'}))
+                    self.thinking = True
+                calls.append(('push_to_chat', {'content': event.text}))
+        elif isinstance(event, ContentDelta):
+            if self.push_to_chat:
+                if self.thinking:
+                    calls.append(('end_block', {}))
+                    self.thinking = False
+                calls.append(('push_to_chat', {'content': event.text}))
+            self.content.append(event.text)
+        elif isinstance(event, Usage):
+            self.usage = event.usage
+        else:
+            if self.usage is not None:
+                calls.append(('log', {'message': str(self.usage)}))
+            if self.push_to_chat:
+                if self.thinking and event.cancelled:
+                    calls.append(('end_block', {}))
+                calls.append(('push_meta', {'content': _meta_data(event.elapsed, self.usage, event.model_name,
+                                                                  event.provider, cached=event.cached,
+                                                                  cancelled=event.cancelled)}))
+                calls.append(('terminate_chat', {}))
+
+        return calls
+
+    def text(self) -> str:
+        return ''.join(self.content)
+
+
+def stream_llm(api: 'ExtensionAPI',
+               model_id: str,
+               messages: List[Dict[str, Any]],
+               *,
+               temperature: float = 1.0,
+               top_p: float = 1.0,
+               n_outputs: int = 1,
+               max_tokens: int = None,
+               cache: bool = False,
+               cache_if: typing.Callable[[str], bool] = None,
+               hedge: bool = False,
+               ) -> typing.Iterator[LLMEvent]:
+    """Stream a response as `ReasoningDelta`, `ContentDelta` and `Usage` events, ending with `Finish`.
+
+    With `cache`, an identical earlier request is answered from the on-disk response cache
+    and replayed as the same events. A sampled response is replayed as is, so a caller that checks
+    the response passes `cache_if`, and only content it accepts is saved.
+
+    With `hedge`, if no token arrives within `HEDGE_DELAY` seconds the same request is also sent to
+    the next configured provider of the model, and the response comes from whichever streams first.
+
+    Once `api` is cancelled the stream is closed at the next chunk. A caller can also stop early by
+    closing the generator; either way a partial response is not cached.
+    """
+
+    selected = _select_providers(api, model_id)
+    if not hedge:
+        selected = selected[:1]
+    provider, api_key, model_name = selected[0]
+
+    def open_stream(provider: Dict[str, str], api_key: 'APIKey', model_name: str):
+        return get_client(provider, api_key).chat.completions.create(
+            model=model_name,
+            messages=_prepare_messages(messages, provider, model_name),
+            stream=True,
+            temperature=temperature,
+            top_p=top_p,
+            n=n_outputs,
+            max_tokens=max_tokens,
+        )
+
+    start_time = time.time()
+
+    key, entry = _cache_lookup(cache, messages, provider, model_name,
+                               temperature=temperature, top_p=top_p, n=n_outputs, max_tokens=max_tokens)
+
+    close = None
+    if entry is not None:
+        deltas = _cached_deltas(entry)
+    elif len(selected) > 1:
+        deltas = _HedgedStream([functools.partial(open_stream, *s) for s in selected], HEDGE_DELAY)
+        close = deltas.close
+    else:
+        stream = open_stream(provider, api_key, model_name)
+        deltas = _stream_deltas(stream)
+        close = stream.close
+
+    transcript = _Transcript()
+    finished = False
+
+    try:
+        for delta in deltas:
+            if api.cancelled:
+                break
+            yield from transcript.events(*delta)
+        else:
+            finished = True
+    finally:
+        if not finished and close is not None:
+            close()
+
+    if isinstance(deltas, _HedgedStream) and deltas.winner is not None:
+        provider, _, model_name = selected[deltas.winner]
+
+    if key is not None and entry is None and finished and (cache_if is None or cache_if(transcript.content())):
+        llm_cache.save(key, transcript.cache_entry())
+
+    yield Finish(provider, model_name, time.time() - start_time, cached=entry is not None, cancelled=not finished)
 
 
 def call_llm(api: 'ExtensionAPI',
              model_id: str,
-             messages: List[Dict[str, str]],
+             messages: List[Dict[str, Any]],
              *,
              push_to_chat: bool = True,
              temperature: float = 1.0,
              top_p: float = 1.0,
              n_outputs: int = 1,
              max_tokens: int = None,
+             cache: bool = False,
+             cache_if: typing.Callable[[str], bool] = None,
+             hedge: bool = False,
+             on_content: typing.Callable[[str], None] = None,
              ):
-    """Streams responses from the LLM and sends them to the chat UI in real-time."""
+    """Streams responses from the LLM and sends them to the chat UI in real-time.
 
-    model_info = MODELS[model_id]
+    Takes the options of `stream_llm`, and returns the response content, or the content so far if `api` is cancelled.
+    `on_content` is called with each piece of content as it streams, for callers that parse it incrementally.
+    """
 
-    if len(api.api_keys.keys) == 0:
-        raise ValueError('API key required. Configure at least one in Extensions → Management.')
+    output = _ChatOutput(push_to_chat)
 
-    api_key, model_name = None, None
-    if api.api_keys.default.provider in model_info:
-        model_name = model_info[api.api_keys.default.provider]
-        api_key = api.api_keys.default
-    else:
-        for k in api.api_keys.keys:
-            if k.provider in model_info:
-                model_name = model_info[k.provider]
-                api_key = k
-                break
+    for event in stream_llm(api, model_id, messages, temperature=temperature, top_p=top_p, n_outputs=n_outputs,
+                            max_tokens=max_tokens, cache=cache, cache_if=cache_if, hedge=hedge):
+        for method, kwargs in output.callbacks(event):
+            getattr(api, method)(**kwargs)
+        if isinstance(event, ContentDelta) and on_content is not None:
+            on_content(event.text)
 
-    if api_key is None:
-        raise ValueError(f"The API provider does not support {model_id} model")
+    return output.text()
 
-    provider = None
-    for p in LLM_PROVIDERS:
-        if p['name'] == api_key.provider:
-            provider = p
-            break
 
-    start_time = time.time()
+def call_fim(api: 'ExtensionAPI',
+             model_id: str,
+             prefix: str,
+             suffix: str,
+             *,
+             stop: List[str] = None,
+             temperature: float = 1.0,
+             top_p: float = 1.0,
+             n_outputs: int = 1,
+             max_tokens: int = None,
+             ) -> List[str]:
+    """Fill in the code between `prefix` and `suffix`, with a model from `FIM_TEMPLATES`.
+
+    The prompt goes to the provider's completions endpoint, without chat framing, and each of the
+    `n_outputs` completions ends at the first of the `stop` sequences. Like `call_llm`, it stops
+    early once `api` is cancelled; nothing is pushed to the chat.
+
+    Returns the completions that came back, which are fewer than `n_outputs` when the provider
+    ignores `n`; that is logged.
+    """
 
-    client = OpenAI(api_key=api_key.key, base_url=provider['base_url'])
+    provider, api_key, model_name = _select_provider(api, model_id)
+    prompt = FIM_TEMPLATES[model_id].format(prefix=prefix, suffix=suffix)
 
-    stream = client.chat.completions.create(
+    start_time = time.time()
+
+    stream = get_client(provider, api_key).completions.create(
         model=model_name,
-        messages=messages,
+        prompt=prompt,
         stream=True,
+        stop=stop,
         temperature=temperature,
         top_p=top_p,
         n=n_outputs,
         max_tokens=max_tokens,
     )
 
-    thinking = False
+    # pieces of each completion, by choice index
+    texts: Dict[int, List[str]] = {}
     usage = None
-    content = ''
+    cancelled = False
 
     for chunk in stream:
-        delta = chunk.choices[0].delta
-        if push_to_chat:
-            if getattr(delta, 'reasoning', None):
-                if not thinking:
-                    api.start_block('think')
-                    thinking = True
-                api.push_to_chat(content=delta.reasoning)
-
-        if delta.content:
-            if push_to_chat:
-                if thinking:
-                    api.end_block()
-                    thinking = False
-                api.push_to_chat(content=delta.content)
-            content += delta.content
+        if api.cancelled:
+            cancelled = True
+            stream.close()
+            break
+
+        for choice in chunk.choices:
+            texts.setdefault(choice.index, [])
+            if choice.text:
+                texts[choice.index].append(choice.text)
 
         if chunk.usage is not None:
-            assert usage is None
             usage = chunk.usage
 
     elapsed = time.time() - start_time
-    meta_data = f'Time: {elapsed:.2f}s'
-    if usage is not None:
-        api.log(str(usage))
+    api.log(_meta_data(elapsed, usage, model_name, provider, cancelled=cancelled))
+    if len(texts) < n_outputs and not cancelled:
+        api.log(f'{model_name} @ {provider["name"]} returned {len(texts)} of {n_outputs} completions')
+
+    return [''.join(texts[i]) for i in sorted(texts)]
+
+
+async def astream_llm(api: 'AsyncExtensionAPI',
+                      model_id: str,
+                      messages: List[Dict[str, Any]],
+                      *,
+                      temperature: float = 1.0,
+                      top_p: float = 1.0,
+                      n_outputs: int = 1,
+                      max_tokens: int = None,
+                      cache: bool = False,
+                      cache_if: typing.Callable[[str], bool] = None,
+                      ) -> typing.AsyncIterator[LLMEvent]:
+    """Async `stream_llm`, from the async OpenAI client. Requests are not hedged."""
+
+    provider, api_key, model_name = _select_provider(api, model_id)
+
+    start_time = time.time()
+
+    key, entry = _cache_lookup(cache, messages, provider, model_name,
+                               temperature=temperature, top_p=top_p, n=n_outputs, max_tokens=max_tokens)
+
+    stream = None
+    if entry is not None:
+        deltas = _acached_deltas(entry)
+    else:
+        stream = await get_async_client(provider, api_key).chat.completions.create(
+            model=model_name,
+            messages=_prepare_messages(messages, provider, model_name),
+            stream=True,
+            temperature=temperature,
+            top_p=top_p,
+            n=n_outputs,
+            max_tokens=max_tokens,
+        )
+        deltas = _astream_deltas(stream)
+
+    transcript = _Transcript()
+    finished = False
+
+    try:
+        async for delta in deltas:
+            if api.cancelled:
+                break
+            for event in transcript.events(*delta):
+                yield event
+        else:
+            finished = True
+    finally:
+        if not finished and stream is not None:
+            await stream.close()
+
+    if key is not None and entry is None and finished and (cache_if is None or cache_if(transcript.content())):
+        llm_cache.save(key, transcript.cache_entry())
+
+    yield Finish(provider, model_name, time.time() - start_time, cached=entry is not None, cancelled=not finished)
+
 
-        meta_data += f' Prompt tokens: {usage.prompt_tokens :,} Completion tokens {usage.completion_tokens :,}, Model: {model_name} @ {provider["name"]}'
+async def acall_llm(api: 'AsyncExtensionAPI',
+                    model_id: str,
+                    messages: List[Dict[str, Any]],
+                    *,
+                    push_to_chat: bool = True,
+                    temperature: float = 1.0,
+                    top_p: float = 1.0,
+                    n_outputs: int = 1,
+                    max_tokens: int = None,
+                    cache: bool = False,
+                    cache_if: typing.Callable[[str], bool] = None,
+                    on_content: typing.Callable[[str], None] = None,
+                    ):
+    """Async `call_llm`, with the same chat output, from the events of `astream_llm`."""
 
-    if push_to_chat:
-        api.push_meta(meta_data.strip())
+    output = _ChatOutput(push_to_chat)
 
-        api.terminate_chat()
+    async for event in astream_llm(api, model_id, messages, temperature=temperature, top_p=top_p,
+                                   n_outputs=n_outputs, max_tokens=max_tokens, cache=cache, cache_if=cache_if):
+        for method, kwargs in output.callbacks(event):
+            await getattr(api, method)(**kwargs)
+        if isinstance(event, ContentDelta) and on_content is not None:
+            on_content(event.text)
 
-    return content
+    return output.text()
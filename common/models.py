@@ -21,5 +21,26 @@ MODELS = {
     },
     'morph_large': {
         'openrouter': 'morph/morph-v3-large'
+    },
+    # base checkpoint; the instruct models are not trained on fill-in-the-middle prompts
+    'qwen_fim': {
+        'deepinfra': 'Qwen/Qwen2.5-Coder-32B'
     }
 }
+
+# Fill-in-the-middle prompt of models that `call_fim` sends to the completions endpoint
+FIM_TEMPLATES = {
+    'qwen_fim': '<|fim_prefix|>{prefix}<|fim_suffix|>{suffix}<|fim_middle|>',
+}
+
+# Context window in tokens; the smallest one when providers serve different variants
+CONTEXT_TOKENS = {
+    'v3': 64_000,
+    'devstral': 128_000,
+    'default': 200_000,
+    'qwen': 256_000,
+    'morph_fast': 32_000,
+    'morph_large': 32_000,
+    'qwen_fim': 32_000,
+}
+DEFAULT_CONTEXT_TOKENS = 32_000
@@ -1,3 +1,5 @@
+import os
+
 LLM_PROVIDERS = [
     {
         'name': 'deepinfra',
@@ -8,3 +10,35 @@ LLM_PROVIDERS = [
         'base_url': 'https://openrouter.ai/api/v1',
     }
 ]
+
+# Connection pool of the HTTP client shared by all calls to one provider
+HTTP_POOL_LIMITS = {
+    'max_connections': 20,
+    'max_keepalive_connections': 10,
+    'keepalive_expiry': 120.0,
+}
+# Use HTTP/2 when the `h2` package is installed
+HTTP2 = True
+
+# Seconds `call_llm(..., hedge=True)` waits for a first token before also asking the next provider
+HEDGE_DELAY = 0.8
+
+# Put the chat context that stays the same between turns before the history, so providers can cache the prompt prefix.
+# This changes the messages the model sees, so it is off unless enabled here
+PROMPT_CACHE_LAYOUT = False
+# Model name prefixes, by provider, that only cache prompts at explicit `cache_control` breakpoints
+PROMPT_CACHE_CONTROL = {
+    'openrouter': ['anthropic/', 'google/'],
+}
+
+# Most tokens of chat context (files, terminal, cursor) to send, even if the model takes more
+MAX_CONTEXT_TOKENS = 60_000
+# Tokens of the context window left for the response
+RESPONSE_TOKENS = 8_192
+
+# On-disk cache of LLM responses for `call_llm(..., cache=True)`
+LLM_CACHE_PATH = os.path.expanduser('~/.cache/notbadai/llm')
+# Seconds a cached response stays valid
+LLM_CACHE_TTL = 24 * 60 * 60
+# Bytes kept on disk before least recently used responses are evicted
+LLM_CACHE_SIZE = 64 * 1024 * 1024
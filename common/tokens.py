@@ -0,0 +1,58 @@
+import re
+from typing import List, Tuple
+
+from .models import CONTEXT_TOKENS, DEFAULT_CONTEXT_TOKENS
+from .settings import MAX_CONTEXT_TOKENS, RESPONSE_TOKENS
+
+# Letters a BPE tokenizer typically keeps in one token of an identifier or word
+CHARS_PER_TOKEN = 4
+
+_PIECES = re.compile(r'[^\W\d_]+|\d+|\n[ \t]*|[^\w\s]|_')
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of `text` without a tokenizer.
+
+    Words cost a token per `CHARS_PER_TOKEN` letters, digits and symbols a token each,
+    and a line break with its indentation one token.
+    """
+    tokens = 0
+    for piece in _PIECES.findall(text):
+        if piece[0].isalpha():
+            tokens += (len(piece) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+        elif piece[0].isdigit():
+            tokens += len(piece)
+        else:
+            tokens += 1
+
+    return tokens
+
+
+def context_budget(model_id: str, *texts: str) -> int:
+    """Tokens left for context in `model_id`'s window after `texts` and the response."""
+    window = CONTEXT_TOKENS.get(model_id, DEFAULT_CONTEXT_TOKENS)
+    used = sum(estimate_tokens(t) for t in texts)
+
+    return max(0, min(MAX_CONTEXT_TOKENS, window - RESPONSE_TOKENS - used))
+
+
+def keep_lines(costs: List[int], budget: int, center: int) -> Tuple[int, int]:
+    """Widest range `[start, end)` of lines around line `center` whose `costs` fit in `budget`.
+
+    The range grows one line at a time on both sides, and on one side only once the other cannot grow.
+    """
+    center = min(max(center, 0), len(costs))
+    start, end = center, center
+    used = 0
+    while True:
+        grew = False
+        if end < len(costs) and used + costs[end] <= budget:
+            used += costs[end]
+            end += 1
+            grew = True
+        if start > 0 and used + costs[start - 1] <= budget:
+            used += costs[start - 1]
+            start -= 1
+            grew = True
+        if not grew:
+            return start, end
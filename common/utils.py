@@ -74,4 +74,44 @@ def parse_json(api: 'ExtensionAPI', response: str):
             return json.loads(block)
         except json.decoder.JSONDecodeError as e:
             api.log(block)
-            raise e
\ No newline at end of file
+            raise e
+
+
+class JSONArrayStream:
+    """Incremental parser for the array of strings under `key` in a streamed JSON response.
+
+    `feed` takes the response text as it arrives and returns the strings completed by it,
+    so that each can be used before the rest of the response is generated.
+    Text around the JSON, such as a markdown code fence, is ignored.
+    """
+
+    _ITEM = re.compile(r'\s*,?\s*("(?:[^"\\]|\\.)*")')
+    _END = re.compile(r'\s*,?\s*\]')
+
+    def __init__(self, key: str):
+        self.start = re.compile(rf'"{re.escape(key)}"\s*:\s*\[')
+        self.text = ''
+        self.pos = None
+        self.done = False
+
+    def feed(self, text: str) -> typing.List[str]:
+        self.text += text
+        if self.pos is None:
+            match = self.start.search(self.text)
+            if match is None:
+                return []
+            self.pos = match.end()
+
+        items = []
+        while not self.done:
+            match = self._ITEM.match(self.text, self.pos)
+            if match is None:
+                self.done = self._END.match(self.text, self.pos) is not None
+                break
+            self.pos = match.end()
+            try:
+                items.append(json.loads(match.group(1)))
+            except json.JSONDecodeError:
+                pass
+
+        return items
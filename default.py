@@ -4,18 +4,43 @@ from typing import List
 from common.api import ExtensionAPI, File
 from common.formatting import markdown_section, markdown_code_block, add_line_comment
 from common.llm import call_llm
+from common.settings import PROMPT_CACHE_LAYOUT
 from common.terminal import get_terminal_snapshot
+from common.tokens import context_budget, estimate_tokens, keep_lines
 from common.utils import parse_prompt, get_prompt_template
 
 
-def build_context(api: 'ExtensionAPI', *,
-                  current_file: File,
-                  other_files: List['File'] = None,
-                  selection: str = None,
-                  terminal: str = None,
-                  cursor: typing.Tuple[int, int] = None,
-                  file_list: List['File'] = None) -> str:
-    """Builds the context string from the current file and selection."""
+# Context parts in the order they are kept when the context does not fit in its token budget
+CURSOR, SELECTION, CURRENT_FILE, OPENED_FILES, TERMINAL, FILE_LIST = range(6)
+
+
+class _Part(typing.NamedTuple):
+    """Lines of a context section, or of one file in it, and how to format them."""
+    section: str
+    label: str
+    priority: int
+    stable: bool
+    lines: List[str]
+    center: int  # line to keep when trimming
+    format: typing.Callable[[str, str], str]  # (text, note on trimmed lines) -> section content
+
+
+def _file_part(section: str, label: str, priority: int, file: File, center: int = 0) -> _Part:
+    def format_(text: str, note: str) -> str:
+        return f'Path: `{file.path}`{note}\n\n' + markdown_code_block(text)
+
+    return _Part(section, label, priority, True, file.get_content().split('\n'), center, format_)
+
+
+def _context_parts(api: 'ExtensionAPI', *,
+                   current_file: File,
+                   other_files: List['File'] = None,
+                   selection: str = None,
+                   terminal: str = None,
+                   cursor: typing.Tuple[int, int] = None,
+                   file_list: List['File'] = None,
+                   sort_files: bool = False) -> List[_Part]:
+    """Context parts in prompt order."""
     context = []
 
     if api.context_files:
@@ -23,7 +48,8 @@ def build_context(api: 'ExtensionAPI', *,
 
     if file_list:
         repo_files = [f'{f.path}`' for f in file_list]
-        context.append(markdown_section("List of Files", "\n".join(repo_files)))
+        context.append(_Part("List of Files", 'file list', FILE_LIST, True, repo_files, 0,
+                             lambda text, note: f'{note.strip()}\n\n{text}' if note else text))
 
     if other_files:
         api.push_meta(f'Opened files: {", ".join(f.path for f in other_files)}')
@@ -31,19 +57,16 @@ def build_context(api: 'ExtensionAPI', *,
     # combine other_files with files from context_files, removing duplicates
     all_files = (other_files or []) + [f for files_list in api.context_files.values() for f in files_list]
     relevant_files = list({f.path: f for f in all_files}.values())
+    if sort_files:
+        relevant_files.sort(key=lambda f: f.path)
 
     if relevant_files:
         api.push_meta(f'Relevant files: {", ".join(f.path for f in relevant_files)}')
-        relevant_files = [f'Path: `{f.path}`\n\n' + markdown_code_block(f.get_content()) for f in relevant_files]
-        context.append(markdown_section("Relevant files", "\n\n".join(relevant_files)))
+        context += [_file_part("Relevant files", f.path, OPENED_FILES, f) for f in relevant_files]
 
     if current_file:
         api.push_meta(f'Current file: {current_file.path}')
-        context.append(
-            markdown_section("Current File",
-                             f"Path: `{current_file.path}`\n\n" +
-                             markdown_code_block(current_file.get_content()))
-        )
+        context.append(_file_part("Current File", 'current file', CURRENT_FILE, current_file, cursor[0] if cursor else 0))
 
     if terminal:
         if len(terminal) > 40_000:
@@ -51,17 +74,14 @@ def build_context(api: 'ExtensionAPI', *,
         else:
             pre_text = f'Terminal output is {len(terminal)} chars long.'
 
-        context.append(
-            markdown_section("Terminal output",
-                             f"{pre_text}\n\n" + markdown_code_block(terminal[-40000:]))
-        )
+        lines = terminal[-40000:].split('\n')
+        context.append(_Part("Terminal output", 'terminal output', TERMINAL, False, lines, len(lines),
+                             lambda text, note: f"{pre_text}{note}\n\n" + markdown_code_block(text)))
 
     if selection and selection.strip():
-        context.append(
-            markdown_section("Selection",
-                             "This is the code snippet that I'm referring to\n\n" +
-                             markdown_code_block(selection))
-        )
+        context.append(_Part("Selection", 'selection', SELECTION, False, selection.split('\n'), 0,
+                             lambda text, note: "This is the code snippet that I'm referring to"
+                                                f"{note}\n\n" + markdown_code_block(text)))
 
     if current_file and cursor:
         block = current_file.get_content().split('\n')
@@ -73,10 +93,119 @@ def build_context(api: 'ExtensionAPI', *,
 
         block = prefix + [line] + suffix
 
-        context.append(markdown_section("Cursor position",
-                                        markdown_code_block('\n'.join(block))))
+        context.append(_Part("Cursor position", 'cursor', CURSOR, False, block, len(prefix),
+                             lambda text, note: markdown_code_block(text)))
+
+    return context
+
+
+def _fit_parts(api: 'ExtensionAPI', parts: List[_Part], budget: typing.Optional[int]) -> List[typing.Optional[str]]:
+    """Formatted content of each part, trimmed or dropped (`None`) by priority to fit in `budget` tokens.
+
+    Parts are trimmed to the lines around their `center`; what was cut is reported in the meta block.
+    """
+    if budget is None:
+        return [part.format('\n'.join(part.lines), '') for part in parts]
+
+    contents = [None] * len(parts)
+    trimmed, dropped = [], []
+    left = budget
+    for i in sorted(range(len(parts)), key=lambda i: parts[i].priority):
+        part = parts[i]
+        overhead = estimate_tokens(part.section) + estimate_tokens(part.format('', ''))
+        costs = [estimate_tokens(line) + 1 for line in part.lines]
+        start, end = keep_lines(costs, left - overhead, part.center)
+        if start == end:
+            dropped.append(part.label)
+            continue
+
+        note = ''
+        if end - start < len(part.lines):
+            note = f' (lines {start + 1}-{end} of {len(part.lines)})'
+            trimmed.append(f'{part.label} to {end - start:,} of {len(part.lines):,} lines')
+        contents[i] = part.format('\n'.join(part.lines[start:end]), note)
+        left -= overhead + sum(costs[start:end])
+
+    report = f'Context: ~{budget - left:,} of {budget:,} tokens'
+    if trimmed:
+        report += f', trimmed {", ".join(trimmed)}'
+    if dropped:
+        report += f', dropped {", ".join(dropped)}'
+    api.push_meta(report)
+
+    return contents
+
+
+def _join_sections(parts: List[_Part], contents: List[typing.Optional[str]]) -> str:
+    sections = {}
+    for part, content in zip(parts, contents):
+        if content is not None:
+            sections.setdefault(part.section, []).append(content)
+
+    return "\n\n".join(markdown_section(title, "\n\n".join(s)) for title, s in sections.items())
+
+
+def build_context(api: 'ExtensionAPI', *, budget: int = None, **kwargs) -> str:
+    """Builds the context string from the current file and selection.
+
+    With a `budget`, lower priority parts are trimmed or left out to keep it within about that many tokens.
+    """
+    parts = _context_parts(api, **kwargs)
+
+    return _join_sections(parts, _fit_parts(api, parts, budget))
+
+
+def build_cached_context(api: 'ExtensionAPI', *, budget: int = None, **kwargs) -> typing.Tuple[str, str]:
+    """`build_context` split into the part that stays the same between chat turns and the part that changes.
+
+    The stable part (file list, files, current file) goes before the chat history so that providers can
+    reuse its prefix cache; the cursor, selection and terminal go with the prompt.
+    """
+    parts = _context_parts(api, sort_files=True, **kwargs)
+    contents = _fit_parts(api, parts, budget)
+    stable = _join_sections(parts, [c if p.stable else None for p, c in zip(parts, contents)])
+    volatile = _join_sections(parts, [c if not p.stable else None for p, c in zip(parts, contents)])
+
+    return stable, volatile
+
 
-    return "\n\n".join(context)
+def context_messages(api: 'ExtensionAPI', model: str, prompt: str, *, log_context: bool = False,
+                     **kwargs) -> List[typing.Dict[str, typing.Any]]:
+    """Chat messages with the context either before the history, or laid out for provider prompt caching.
+
+    With `log_context` the context is also logged.
+    """
+    system = get_prompt_template('chat.system', model=model)
+    history = [m.to_dict() for m in api.chat_history]
+    kwargs['budget'] = context_budget(model, system, prompt, *(str(m['content']) for m in history))
+
+    if not PROMPT_CACHE_LAYOUT:
+        context = build_context(api, **kwargs)
+        api.push_block('meta', f'With context: {len(context) :,} characters,'
+                               f' selection: {bool(api.selection)}')
+        if log_context:
+            api.log(context)
+        return [
+            {'role': 'system', 'content': system},
+            {'role': 'user', 'content': context},
+            *history,
+            {'role': 'user', 'content': prompt},
+        ]
+
+    stable, volatile = build_cached_context(api, **kwargs)
+    api.push_block('meta', f'With context: {len(stable) + len(volatile) :,} characters'
+                           f' ({len(stable) :,} cacheable), selection: {bool(api.selection)}')
+    if log_context:
+        api.log('\n\n'.join(part for part in (stable, volatile) if part))
+
+    # `cache` marks the end of a prefix that providers can cache, see `call_llm`
+    messages = [{'role': 'system', 'content': system, 'cache': True}]
+    if stable:
+        messages.append({'role': 'user', 'content': stable, 'cache': True})
+    messages += history
+    messages.append({'role': 'user', 'content': f'{volatile}\n\n{prompt}' if volatile else prompt})
+
+    return messages
 
 
 def extension(api: ExtensionAPI):
@@ -97,42 +226,24 @@ def extension(api: ExtensionAPI):
             {'role': 'user', 'content': prompt},
         ]
     elif command == 'here':
-        context = build_context(api,
-                                other_files=api.opened_files,
-                                selection=api.selection,
-                                file_list=api.repo_files,
-                                current_file=api.current_file,
-                                terminal=terminal_snapshot,
-                                cursor=(api.cursor_row, api.cursor_column),
-                                )
-
-        api.push_block('meta', f'With context: {len(context) :,} characters,'
-                               f' selection: {bool(api.selection)}')
-        api.log(context)
-        messages = [
-            {'role': 'system', 'content': get_prompt_template('chat.system', model=model)},
-            {'role': 'user', 'content': context},
-            *[m.to_dict() for m in api.chat_history],
-            {'role': 'user', 'content': prompt},
-        ]
+        messages = context_messages(api, model, prompt,
+                                    other_files=api.opened_files,
+                                    selection=api.selection,
+                                    file_list=api.repo_files,
+                                    current_file=api.current_file,
+                                    terminal=terminal_snapshot,
+                                    cursor=(api.cursor_row, api.cursor_column),
+                                    log_context=True,
+                                    )
     elif command == 'context':
-        context = build_context(api,
-                                other_files=api.opened_files,
-                                selection=api.selection,
-                                file_list=api.repo_files,
-                                current_file=api.current_file,
-                                terminal=terminal_snapshot,
-                                cursor=(api.cursor_row - 1, api.cursor_column - 1),
-                                )
-        api.push_block('meta', f'With context: {len(context) :,} characters,'
-                               f' selection: {bool(api.selection)}')
-        # api.log(context)
-        messages = [
-            {'role': 'system', 'content': get_prompt_template('chat.system', model=model)},
-            {'role': 'user', 'content': context},
-            *[m.to_dict() for m in api.chat_history],
-            {'role': 'user', 'content': prompt},
-        ]
+        messages = context_messages(api, model, prompt,
+                                    other_files=api.opened_files,
+                                    selection=api.selection,
+                                    file_list=api.repo_files,
+                                    current_file=api.current_file,
+                                    terminal=terminal_snapshot,
+                                    cursor=(api.cursor_row - 1, api.cursor_column - 1),
+                                    )
     else:
         raise ValueError(f'Unknown command: {command}')
 
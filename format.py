@@ -1,7 +1,8 @@
-import black
-from black import FileMode
 from common.api import ExtensionAPI
 from common.diff import get_matches
+from common.imports import lazy_import
+
+black = lazy_import('black')
 
 
 def format_source_code(code: str):
@@ -10,7 +11,7 @@ def format_source_code(code: str):
     """
     try:
         # Format the code using black
-        formatted_code = black.format_str(code, mode=FileMode())
+        formatted_code = black.format_str(code, mode=black.FileMode())
         return formatted_code
     except Exception as e:
         # If formatting fails, return the original code
@@ -74,6 +74,16 @@ def parse_result(response: str, api: ExtensionAPI, ) -> Tuple[Dict[str, any], Li
         return {}, data['suggested_files']
 
 
+def is_result(response: str, api: ExtensionAPI) -> bool:
+    """Whether `parse_result` accepts `response`, so that it is worth caching."""
+    try:
+        parse_result(response, api)
+    except Exception:
+        return False
+
+    return True
+
+
 def extension(api: ExtensionAPI):
     # we allow up to 3 extra passes
     MAX_ITER = 3
@@ -104,7 +114,8 @@ def extension(api: ExtensionAPI):
         ]
 
         api.log(f"Lookup iteration {iteration}: sending {len(related_files)} files")
-        raw_response = call_llm(api, 'qwen', messages)
+        raw_response = call_llm(api, 'qwen', messages, cache=True,
+                                cache_if=lambda response: is_result(response, api))
         api.log(raw_response)
 
         location, suggested_files = parse_result(raw_response, api)